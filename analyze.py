@@ -0,0 +1,215 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import os
+import sys
+import csv
+import math
+import multiprocessing
+import hqm
+import capture
+from hqmworld import object_positions
+
+# Per match and player:
+#   goals, assists : From the GOAL events
+#   possession     : Seconds the player's stick was the nearest one to a puck, within possession_range
+#   distance       : Meters skated
+#   shot_speed     : Fastest puck in m/s up to shot_window simsteps after the player last had it
+# All speeds and distances come from positions in consecutive game updates.
+match_fields = ("file", "server", "game", "name", "team", "goals", "assists", "possession", "distance", "shot_speed")
+
+possession_range = 1.0
+shot_window = 50
+max_step_gap = 100        # Simsteps. Longer gaps between updates are not measured over
+max_skating_speed = 0.2   # Meters per simstep, faster moves are teleports
+max_puck_speed = 0.6      # Meters per simstep, faster moves are faceoffs
+
+def print_help():
+    print("Usage: analyze.py <directory> [-p <processes>] [-o <file>]")
+    print("  -p : Number of processes, default is the number of CPU cores")
+    print("  -o : Also writes one CSV row per match and player to file, as matches finish")
+
+def find_captures(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if capture.is_capture(path):
+                yield path
+
+def team_name(team):
+    if team == 0:
+        return "RED"
+    elif team == 1:
+        return "BLUE"
+    return "-"
+
+def stick_position(obj, pos):
+    # Like HQMObjectState.calculate_positions, without decoding rotations
+    values = [obj.get(key) for key in ("stick_x_int", "stick_y_int", "stick_z_int")]
+    if None in values:
+        return None
+    return [value/1024 + p - 4.0 for value, p in zip(values, pos)]
+
+def distance(a, b):
+    return math.sqrt((a[0]-b[0])**2 + (a[1]-b[1])**2 + (a[2]-b[2])**2)
+
+def analyze_capture(path):
+    # Returns (path, list of match rows, error message)
+    rows = {}
+    game = None
+    server = None
+
+    def get_row(name):
+        row = rows.get((game, name))
+        if row is None:
+            row = dict.fromkeys(match_fields, 0)
+            row.update(file=os.path.basename(path), server=server, game=game, name=name, team="-")
+            rows[(game, name)] = row
+        return row
+
+    try:
+        with capture.CaptureReader(path) as reader:
+            server = reader.server
+        for arrival, gamestate, events in capture.replay(path):
+            if gamestate.id != game:
+                game = gamestate.id
+                player_list = {}
+                last_simstep = None
+                last_players = {}  # Object index -> (player index, position)
+                last_pucks = {}    # Object index -> position
+                last_touch = {}    # Puck object index -> (name, simstep)
+            for msg in events:
+                hqm.update_player_list(player_list, msg)
+                if msg["type"] == "GOAL":
+                    for role, key in (("scoring_player", "goals"), ("assisting_player", "assists")):
+                        player = player_list.get(msg[role])
+                        if player:
+                            get_row(player["name"])[key] += 1
+
+            steps = None if last_simstep is None else gamestate.simstep - last_simstep
+            if steps is not None and (steps <= 0 or steps > max_step_gap):
+                steps = None
+            last_simstep = gamestate.simstep
+
+            players = {}
+            sticks = []
+            pucks = {}
+            indices = list(gamestate.objects)
+            positions = object_positions(gamestate.objects, indices).tolist()
+            for i, pos in zip(indices, positions):
+                if any(math.isnan(value) for value in pos):
+                    continue
+                obj = gamestate.objects[i]
+                if obj["type"] == "PUCK":
+                    pucks[i] = pos
+                    continue
+                player_index = gamestate.object_players.get(i)
+                player = gamestate.players.get(player_index)
+                if player is None:
+                    continue
+                players[i] = (player_index, pos)
+                row = get_row(player["name"])
+                row["team"] = team_name(player["team"])
+                last = last_players.get(i)
+                if steps and last is not None and last[0] == player_index:
+                    moved = distance(pos, last[1])
+                    if moved <= max_skating_speed*steps:
+                        row["distance"] += moved
+                stick = stick_position(obj, pos)
+                if stick is not None:
+                    sticks.append((player["name"], stick))
+
+            for i, pos in pucks.items():
+                holder = None
+                nearest = possession_range
+                for name, stick in sticks:
+                    d = distance(pos, stick)
+                    if d < nearest:
+                        holder, nearest = name, d
+                if holder is not None:
+                    last_touch[i] = (holder, gamestate.simstep)
+                    if steps:
+                        get_row(holder)["possession"] += steps / hqm.tick_rate
+                elif steps and i in last_pucks and i in last_touch:
+                    name, touched = last_touch[i]
+                    speed = distance(pos, last_pucks[i]) / steps
+                    if gamestate.simstep - touched <= shot_window and speed <= max_puck_speed:
+                        row = get_row(name)
+                        row["shot_speed"] = max(row["shot_speed"], speed*hqm.tick_rate)
+            last_players = players
+            last_pucks = pucks
+    except Exception as ex:
+        # A corrupt capture, which can fail anywhere in decoding, must not
+        # stop the other workers
+        return path, None, "{}: {}".format(type(ex).__name__, ex)
+    return path, list(rows.values()), None
+
+def add_totals(totals, rows):
+    for row in rows:
+        total = totals.get(row["name"])
+        if total is None:
+            total = totals[row["name"]] = {"matches": 0, "goals": 0, "assists": 0,
+                                           "possession": 0.0, "distance": 0.0, "shot_speed": 0.0}
+        total["matches"] += 1
+        for key in ("goals", "assists", "possession", "distance"):
+            total[key] += row[key]
+        total["shot_speed"] = max(total["shot_speed"], row["shot_speed"])
+
+def print_totals(totals):
+    format = "{:<32}{:>8}{:>6}{:>6}{:>12}{:>12}{:>10}"
+    print(format.format("NAME", "MATCHES", "G", "A", "POSS S", "DIST M", "SHOT M/S"))
+    for name in sorted(totals, key=lambda name: (-totals[name]["goals"], name)):
+        total = totals[name]
+        print(format.format(name, total["matches"], total["goals"], total["assists"],
+            "{:.1f}".format(total["possession"]), "{:.0f}".format(total["distance"]),
+            "{:.1f}".format(total["shot_speed"])))
+
+def run_analysis(paths, processes=None, output=None):
+    # Captures are analyzed in a pool as paths are listed, and each result
+    # is merged and written as soon as it is done, so only the totals are kept
+    totals = {}
+    matches = 0
+    writer = None
+    out = None
+    if output is not None:
+        out = open(output, "w", newline="")
+        writer = csv.DictWriter(out, fieldnames=match_fields)
+        writer.writeheader()
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            for path, rows, error in pool.imap_unordered(analyze_capture, paths):
+                if error is not None:
+                    print("{}: {}".format(path, error), file=sys.stderr)
+                    continue
+                matches += 1
+                add_totals(totals, rows)
+                if writer is not None:
+                    for row in rows:
+                        writer.writerow(dict(row, possession="{:.2f}".format(row["possession"]),
+                                             distance="{:.1f}".format(row["distance"]),
+                                             shot_speed="{:.1f}".format(row["shot_speed"])))
+                    out.flush()
+    finally:
+        if out is not None:
+            out.close()
+    print("{} captures".format(matches))
+    print_totals(totals)
+    return totals
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args)==0:
+        print_help()
+        sys.exit(1)
+    try:
+        processes = int(args[args.index("-p")+1]) if "-p" in args else None
+        output = args[args.index("-o")+1] if "-o" in args else None
+    except (ValueError, IndexError):
+        print_help()
+        sys.exit(1)
+    try:
+        run_analysis(find_captures(args[0]), processes, output)
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -130,6 +130,9 @@ class CSBitReader():
             result = (-1 << length) | result 
         return result
         
+    def skip(self, length):
+        self.pos += length
+        
     def read_unsigned_or_minus_one(self, length):
         result = self.read_unsigned(length)
         if result == (1 << length)-1:
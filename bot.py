@@ -1,5 +1,7 @@
 import hqm
 import socket
+import selectors
+import time
 
 
 class HQMBot():
@@ -8,25 +10,42 @@ class HQMBot():
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
         self.session = hqm.HQMClientSession(name, 55)
         self.syncing = True
+        self.stats = {
+            "ticks": 0,       # Number of sent updates
+            "packets": 0,     # Number of received datagrams
+            "dropped": 0,     # Server packets that never arrived
+            "overruns": 0,    # Ticks where action() used more than the tick budget
+            "action_time": 0.0, # Total time spent in action(), in seconds
+            "action_max": 0.0,
+            "late_time": 0.0, # Total time ticks were sent later than scheduled
+            "late_max": 0.0
+        }
                
     def run(self):
-        try:
-            while True:
-                send = self.session.get_message()
-                self.socket.sendto(send, (self.host, self.port))
-                data = self.socket.recv(8192) 
-                self.dataReceived(data)
-        except KeyboardInterrupt:
-            send = self.session.get_exit_message()
-            self.socket.sendto(send, (self.host, self.port))
-
+        run_bots([self])
         
-    def dataReceived(self, data):
-        self.session.parse_message(data)
-        if self.session.last_message_num == 0:
-            self.syncing = False
+    def receive(self, max_batch=64):
+        # Reads what has arrived without blocking, at most max_batch datagrams
+        # so a flood can't delay the next tick. The rest is read on the next wakeup.
+        # All datagrams are decoded since later packets are deltas against them,
+        # but action() only ever sees the newest state.
+        for i in range(max_batch):
+            try:
+                data = self.socket.recv(8192) 
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return # ICMP errors such as port unreachable
+            self.dataReceived(data)
+            
+    def tick(self, budget, late=0.0):
+        stats = self.stats
+        if self.session.reorder_buffer:
+            # Don't wait for missing updates past the reorder delay
+            self.session.flush_reorder_buffer()
         gamestate = self.session.gamestate    
         if not self.syncing and gamestate:
             you = gamestate.you
@@ -39,7 +58,34 @@ class HQMBot():
                     self.session.join_team(-1) # Back to spectator so we can switch team
                 else:
                     self.session.join_team(None)                              
+                start = time.perf_counter()
                 self.action() #Let's do stuff
+                action_time = time.perf_counter() - start
+                stats["action_time"] += action_time
+                stats["action_max"] = max(stats["action_max"], action_time)
+                if action_time > budget:
+                    stats["overruns"] += 1
+        send = self.session.get_message()
+        self.socket.sendto(send, (self.host, self.port))
+        stats["ticks"] += 1
+        stats["late_time"] += late
+        stats["late_max"] = max(stats["late_max"], late)
+        
+    def exit(self):
+        send = self.session.get_exit_message()
+        self.socket.sendto(send, (self.host, self.port))
+        
+    def dataReceived(self, data):
+        old_gamestate = self.session.gamestate
+        self.session.parse_message(data)
+        self.stats["packets"] += 1
+        if self.session.last_message_num == 0:
+            self.syncing = False
+        gamestate = self.session.gamestate    
+        if gamestate and old_gamestate and gamestate is not old_gamestate and gamestate.id == old_gamestate.id:
+            missing = gamestate.packet - old_gamestate.packet - 1
+            if missing > 0:
+                self.stats["dropped"] += missing
                
         
     def spectate(self):
@@ -71,7 +117,7 @@ class TestBot(HQMBot):
         
         objects = gamestate.objects
         # A dictionary of all the objects in the server. These include both players and pucks.
-        # For player objects, you need the player list to determine which object belongs to which player.
+        # gamestate.object_player(i) returns the player controlling object i, or None for pucks.
         # Each object is a dictonary. You need to run object.calculate_positions()
         # for each object to calculate some useful position data.
         # Both players and pucks have these keys after calculate_positions():
@@ -84,30 +130,23 @@ class TestBot(HQMBot):
         #   head_rot   : Head rotation, left (-)/right (+), a float with rotation in radians
         #   body_rot   : Body rotation, backwards (-)/forwards (+), a float with rotation in radians
              
-        pucks = []
-        teammates = []
-        opponents = []
-        you = None
+        world = gamestate.world
+        # The world model is computed once per gamestate and shared by everything using it.
+        #   world.positions       : A numpy array with the position of every object,
+        #                           in the order of world.indices
+        #   world.team_indices    : Object indices of the players in each team, {0: red, 1: blue}
+        #   world.team_positions  : Positions of the players in each team
+        #   world.distances       : Distances between all objects
+        #   world.velocities      : Object movement per simstep since the previous gamestate
+        #   world.nearest_puck(p) : The index of the puck nearest to p and its distance
         
-        for object in objects.values():
-            object.calculate_positions()
-            if object["type"] == "PUCK":
-                pucks.append(object)
-                
         you_player = players[gamestate.you]
+        you_obj = world.player_object(gamestate.you)
         
-        you_obj = objects[you_player["obj"]]
-        
-        for i, player in players.items():  
-            if i==you or player["obj"] == -1: # If the player is you, or a spectator
-                continue
-            player_obj = objects[player["obj"]]
-
-            if player["team"]==you_player["team"]:
-                teammates.append(player_obj)
-            else:
-                opponents.append(player_obj)
-         
+        team = you_player["team"]
+        teammates = [i for i in world.team_indices[team] if i != you_obj]
+        opponents = world.team_indices[1-team]
+        puck, puck_distance = world.nearest_puck(world.position(you_obj))
             
         session.move_lr = 1        # Turn left/right, normal values are -1.0 (move left), 0 or 1.0 (move right)
         session.move_fwbw = 1.0    # Forwards/Backwards, normal values are -1.0 (backwards), 0 or 1.0 (forwards)
@@ -123,3 +162,34 @@ class TestBot(HQMBot):
         if gamestate.simstep%2000==500:
             session.add_chat("MigoBot")
            
+
+def run_bots(bots, rate=hqm.tick_rate, report=None, report_interval=1.0):
+    # Runs any number of bots in this thread. Updates are sent at a fixed
+    # rate no matter when replies arrive, and received datagrams are handled
+    # as soon as they arrive. If given, report(bots) is called every
+    # report_interval seconds.
+    interval = 1/rate
+    next_report = time.monotonic() + report_interval
+    with selectors.DefaultSelector() as selector:
+        for bot in bots:
+            selector.register(bot.socket, selectors.EVENT_READ, bot)
+        next_tick = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= next_tick:
+                    late = now - next_tick
+                    for bot in bots:
+                        bot.tick(interval, late)
+                    next_tick += interval
+                    if next_tick < now:
+                        next_tick = now + interval # Skip ticks we are too late for
+                    if report and now >= next_report:
+                        report(bots)
+                        next_report = now + report_interval
+                timeout = max(0, next_tick - time.monotonic())
+                for key, mask in selector.select(timeout):
+                    key.data.receive()
+        except KeyboardInterrupt:
+            for bot in bots:
+                bot.exit()
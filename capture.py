@@ -0,0 +1,119 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+# Match captures: every datagram a session received from a server, with its
+# arrival time. Feeding them to a new HQMClientSession in the same order
+# decodes the match again, so anything can be computed from it afterwards.
+#
+# A capture starts with the line "HQMCAP 1", followed by a line of JSON with
+# the server address and when the capture started. After that come the
+# datagrams, each one as a little-endian double with the arrival time
+# (seconds since the epoch), an unsigned short with the length and the data.
+# Files ending with .gz are compressed.
+
+import gzip
+import json
+import time
+import struct
+import hqm
+
+magic = b"HQMCAP 1\n"
+record_header = struct.Struct("<dH")
+
+def open_file(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def is_capture(path):
+    try:
+        with open_file(path, "rb") as f:
+            return f.read(len(magic)) == magic
+    except OSError:
+        return False
+
+class CaptureWriter:
+    def __init__(self, path, server):
+        self.path = path
+        self.file = open_file(path, "wb")
+        self.file.write(magic)
+        header = {"server": server, "start": time.time()}
+        self.file.write(json.dumps(header).encode("utf-8") + b"\n")
+        self.count = 0
+
+    def write(self, data, arrival=None):
+        if arrival is None:
+            arrival = time.time()
+        self.file.write(record_header.pack(arrival, len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open_file(path, "rb")
+        if self.file.readline() != magic:
+            self.file.close()
+            raise ValueError("{} is not a capture".format(path))
+        self.header = json.loads(self.file.readline().decode("utf-8"))
+        self.server = self.header["server"]
+
+    def __iter__(self):
+        # Yields (arrival time, datagram). A record cut short at the end of
+        # the file, as left by a recording that was killed, is ignored.
+        size = record_header.size
+        while True:
+            header = self.file.read(size)
+            if len(header) < size:
+                return
+            arrival, length = record_header.unpack(header)
+            data = self.file.read(length)
+            if len(data) < length:
+                return
+            yield arrival, data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def replay(path, session=None, on_error=None):
+    # Decodes a capture and yields (arrival time, gamestate, new events) for
+    # every datagram that gave a new game state. Events are new since the
+    # previous yield, or since the start of a new game.
+    # If on_error is given, datagrams that can't be decoded are skipped and
+    # on_error(arrival time, exception) is called, otherwise the exception
+    # is raised.
+    if session is None:
+        session = hqm.HQMClientSession("MigoMibot", 55)
+    last_game_id = None
+    last_msg_pos = 0
+    with CaptureReader(path) as reader:
+        last = None
+        for arrival, data in reader:
+            try:
+                gamestate = session.parse_message(data)
+            except Exception as ex:
+                if on_error is None:
+                    raise
+                on_error(arrival, ex)
+                continue
+            if gamestate is None or gamestate is last:
+                continue
+            last = gamestate
+            if gamestate.id != last_game_id:
+                last_game_id = gamestate.id
+                last_msg_pos = 0
+            events = []
+            if gamestate.msg_pos > last_msg_pos:
+                events = gamestate.events[last_msg_pos:gamestate.msg_pos]
+                last_msg_pos = gamestate.msg_pos
+            yield arrival, gamestate, events
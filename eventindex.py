@@ -0,0 +1,199 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+# An SQLite database of the events of many matches, filled from captures
+# and from monitor logs written as JSON lines. Every source remembers how
+# far it has been read, so ingesting a file again only adds what is new,
+# and an interrupted ingest continues where the last committed batch ended.
+
+import os
+import json
+import sqlite3
+import hqm
+import capture
+from eventsink import record_fields, get_log_record
+
+schema = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL -- Bytes read of logs, events read of captures
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    time REAL,
+    server TEXT,
+    game INTEGER,
+    simstep INTEGER,
+    type TEXT,
+    player INTEGER,
+    name TEXT,
+    team TEXT,
+    message TEXT,
+    scoring_player INTEGER,
+    scoring_name TEXT,
+    assisting_player INTEGER,
+    assisting_name TEXT
+);
+CREATE INDEX IF NOT EXISTS events_game ON events (server, game, simstep);
+CREATE INDEX IF NOT EXISTS events_name ON events (name, type);
+CREATE INDEX IF NOT EXISTS events_scoring ON events (scoring_name);
+CREATE INDEX IF NOT EXISTS events_assisting ON events (assisting_name);
+CREATE INDEX IF NOT EXISTS events_type ON events (type, time);
+"""
+
+insert_sql = "INSERT INTO events (source, {}) VALUES (?, {})".format(
+    ", ".join(record_fields), ", ".join("?" for field in record_fields))
+
+def capture_records(path, on_error=None):
+    # The events of a capture as monitor log records. on_error is passed
+    # to capture.replay.
+    player_list = {}
+    last_game_id = None
+    with capture.CaptureReader(path) as reader:
+        server = reader.server
+    for arrival, gamestate, events in capture.replay(path, on_error=on_error):
+        if gamestate.id != last_game_id:
+            last_game_id = gamestate.id
+            player_list = {}
+        for msg in events:
+            hqm.update_player_list(player_list, msg)
+            record = get_log_record(msg, player_list)
+            record["time"] = arrival
+            record["server"] = server
+            record["game"] = gamestate.id
+            record["simstep"] = gamestate.simstep
+            yield record
+
+class HQMEventIndex:
+    def __init__(self, path, batch_size=5000):
+        self.path = path
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def get_position(self, path, kind):
+        row = self.db.execute("SELECT kind, position FROM sources WHERE path = ?", (path,)).fetchone()
+        if row is None or row["kind"] != kind:
+            return 0
+        return row["position"]
+
+    def forget(self, path):
+        with self.db:
+            self.db.execute("DELETE FROM events WHERE source = ?", (path,))
+            self.db.execute("DELETE FROM sources WHERE path = ?", (path,))
+
+    def commit_batch(self, path, kind, rows, position):
+        # The rows and the new position are committed together, so after a
+        # crash the source is read again from exactly after the last batch
+        with self.db:
+            self.db.executemany(insert_sql, rows)
+            self.db.execute("INSERT OR REPLACE INTO sources (path, kind, position) VALUES (?, ?, ?)",
+                            (path, kind, position))
+
+    def ingest(self, path, on_error=None):
+        # Returns the number of new events. on_error is called for
+        # datagrams of captures that can't be decoded, see capture.replay.
+        path = os.path.abspath(path)
+        if capture.is_capture(path):
+            return self.ingest_capture(path, on_error)
+        return self.ingest_log(path)
+
+    def ingest_log(self, path):
+        position = self.get_position(path, "log")
+        if os.path.getsize(path) < position:
+            # Replaced or truncated, start over
+            self.forget(path)
+            position = 0
+        added = 0
+        rows = []
+        with open(path, "rb") as f:
+            f.seek(position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # Still being written
+                position += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(record, dict):
+                    continue
+                rows.append([path] + [record.get(field) for field in record_fields])
+                if len(rows) >= self.batch_size:
+                    self.commit_batch(path, "log", rows, position)
+                    added += len(rows)
+                    rows = []
+        self.commit_batch(path, "log", rows, position)
+        return added + len(rows)
+
+    def ingest_capture(self, path, on_error=None):
+        # Captures have to be decoded from the start, events that are
+        # already in the database are skipped. Corrupt datagrams are skipped
+        # too, the same ones every time, so the event count stays valid.
+        if on_error is None:
+            on_error = lambda arrival, ex: None
+        done = self.get_position(path, "capture")
+        position = 0
+        added = 0
+        rows = []
+        for record in capture_records(path, on_error):
+            position += 1
+            if position <= done:
+                continue
+            rows.append([path] + [record.get(field) for field in record_fields])
+            if len(rows) >= self.batch_size:
+                self.commit_batch(path, "capture", rows, position)
+                added += len(rows)
+                rows = []
+        if rows or position > done:
+            self.commit_batch(path, "capture", rows, position)
+        return added + len(rows)
+
+    def find(self, type=None, name=None, scorer=None, text=None, server=None, game=None,
+             since=None, until=None, limit=None):
+        # Events matching all the given conditions, oldest first. name
+        # matches the player, scorer or assister, text is a part of a message.
+        conditions = []
+        params = []
+        if scorer is not None:
+            conditions.append("scoring_name = ?")
+            params.append(scorer)
+        if type is not None:
+            conditions.append("type = ?")
+            params.append(type)
+        if name is not None:
+            conditions.append("(name = ? OR scoring_name = ? OR assisting_name = ?)")
+            params.extend((name, name, name))
+        if text is not None:
+            conditions.append("message LIKE ? ESCAPE '\\'")
+            escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append("%" + escaped + "%")
+        if server is not None:
+            conditions.append("server = ?")
+            params.append(server)
+        if game is not None:
+            conditions.append("game = ?")
+            params.append(game)
+        if since is not None:
+            conditions.append("time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            params.append(until)
+        sql = "SELECT {} FROM events".format(", ".join(record_fields))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY time, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [dict(row) for row in self.db.execute(sql, params)]
@@ -0,0 +1,230 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import io
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import threading
+
+# Keys of an event record. Keys that don't apply to an event are None.
+record_fields = ("time", "server", "game", "simstep", "type", "player", "name", "team", "message",
+                 "scoring_player", "scoring_name", "assisting_player", "assisting_name")
+
+def int_to_team(n):
+    if n == -1:
+        team = "-"
+    elif n == 0:
+        team = "RED"
+    elif n == 1:
+        team = "BLUE"
+    return team
+
+def get_log_fields(msg, player_list):
+    type = msg["type"]
+    if type=="JOIN":
+        i = msg["player"]
+        name = msg["name"]
+        team = int_to_team(msg["team"])
+        message = ""
+    elif type=="EXIT":
+        i = msg["player"]
+        name = msg["name"]
+        team = ""
+        message = ""
+    elif type=="GOAL":
+        i = ""
+        name = ""
+        team = int_to_team(msg["team"])
+        scoring = player_list.get(msg["scoring_player"])
+        assisting = player_list.get(msg["assisting_player"])
+        if assisting:
+            message = "{}(#{}), assisted by {}(#{})".format(
+                scoring["name"], scoring["index"], assisting ["name"], assisting ["index"])
+        elif scoring:
+            message = "{}(#{}) ".format(
+                scoring["name"], scoring["index"])
+        else:
+            message = ""
+    elif type=="CHAT":
+        i = msg["player"]
+        if i==-1:
+            i = ""
+            name = ""
+            team = ""
+        else:
+            chatter = player_list.get(i)
+            if chatter is None:
+                # Joined before the first event we have
+                name = ""
+                team = ""
+            else:
+                name = chatter["name"]
+                team = int_to_team(chatter["team"])
+        message = msg["message"]
+    return type, i, name, team, message
+
+def get_log_line(msg, format, player_list):
+    return format.format(*get_log_fields(msg, player_list))
+
+def get_log_record(msg, player_list):
+    fields = get_log_fields(msg, player_list)
+    record = dict(zip(("type", "player", "name", "team", "message"), fields))
+    for key, value in record.items():
+        if value == "":
+            record[key] = None
+    if msg["type"]=="GOAL":
+        for role in ("scoring", "assisting"):
+            player = player_list.get(msg[role + "_player"])
+            record[role + "_player"] = player["index"] if player else None
+            record[role + "_name"] = player["name"] if player else None
+    return record
+
+class TextEncoder:
+    def __init__(self, format="{:<6}{:<4}{:<32}{:<6}{}"):
+        self.format = format
+
+    def header(self):
+        return self.format.format("TYPE", "#", "NAME", "TEAM", "MESSAGE") + "\n"
+
+    def encode(self, record):
+        values = [record.get(key) for key in ("type", "player", "name", "team", "message")]
+        values = ["" if value is None else value for value in values]
+        return self.format.format(*values) + "\n"
+
+class JSONLinesEncoder:
+    def header(self):
+        return ""
+
+    def encode(self, record):
+        return json.dumps(record, separators=(",", ":")) + "\n"
+
+class CSVEncoder:
+    def header(self):
+        return ",".join(record_fields) + "\r\n"
+
+    def encode(self, record):
+        out = io.StringIO()
+        csv.writer(out).writerow([record.get(key) for key in record_fields])
+        return out.getvalue()
+
+encoders = {
+    "text": TextEncoder,
+    "json": JSONLinesEncoder,
+    "csv": CSVEncoder
+}
+
+class EventSink:
+    # Writes records from a background thread. put() never blocks: if the
+    # queue is full because output can't keep up, the record is dropped and
+    # counted in self.dropped.
+    def __init__(self, encoder, path=None, stream=None, max_queue=10000,
+                 batch_size=256, flush_interval=0.5, rotate_bytes=0, rotate_count=5):
+        self.encoder = encoder
+        self.path = path
+        self.stream = stream if stream is not None else sys.stdout
+        self.file = None
+        self.size = 0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_count = rotate_count
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.path is not None:
+            self._open()
+        else:
+            self.stream.write(self.encoder.header())
+        self.thread.start()
+        return self
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _open(self):
+        # Binary, so that size counts the bytes in the file
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        if self.size == 0:
+            self._write(self.encoder.header())
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.rotate_count-1, 0, -1):
+            old_path = "{}.{}".format(self.path, i)
+            if os.path.exists(old_path):
+                os.replace(old_path, "{}.{}".format(self.path, i+1))
+        if self.rotate_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _write(self, text):
+        if self.file is not None:
+            data = text.encode("utf-8")
+            self.file.write(data)
+            self.size += len(data)
+        else:
+            self.stream.write(text)
+
+    def _run(self):
+        try:
+            self._write_loop()
+        except OSError as ex:
+            # The output is gone (closed pipe, full disk...), stop writing.
+            # Everything put after this is counted as dropped.
+            self.error = ex
+
+    def _write_loop(self):
+        last_flush = time.monotonic()
+        unflushed = False
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            if batch:
+                self._write("".join(self.encoder.encode(record) for record in batch))
+                self.written += len(batch)
+                unflushed = True
+                if self.file is not None and self.rotate_bytes and self.size >= self.rotate_bytes:
+                    self._rotate()
+            now = time.monotonic()
+            if unflushed and (not running or not batch or now - last_flush >= self.flush_interval):
+                out = self.file if self.file is not None else self.stream
+                out.flush()
+                unflushed = False
+                last_flush = now
@@ -0,0 +1,147 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import importlib
+import multiprocessing
+import bot
+
+# The config file is a JSON list of bots:
+# [
+#   {"host": "127.0.0.1", "port": 27585, "team": 0, "name": "RedBot", "bot": "bot.TestBot", "count": 10},
+#   {"host": "127.0.0.1", "port": 27585, "team": 1, "name": "BlueBot", "bot": "bot.TestBot", "count": 10}
+# ]
+# "bot" is the module and class name of a HQMBot subclass. With "count", that
+# many bots are started with a number added to the name.
+
+def print_help():
+    print("Usage: fleet.py <config> [-p <processes>] [-i <seconds>]")
+    print("  -p : Number of processes, default is the number of CPU cores")
+    print("  -i : How often statistics are printed, default is every 5 seconds")
+
+def load_config(path):
+    with open(path, "r") as f:
+        config = json.load(f)
+    entries = []
+    for entry in config:
+        count = entry.get("count")
+        if count is None:
+            entries.append(entry)
+            continue
+        for i in range(1, count+1):
+            copy = dict(entry)
+            del copy["count"]
+            copy["name"] = "{}{}".format(entry["name"], i)
+            entries.append(copy)
+    return entries
+
+def get_bot_class(name):
+    module_name, sep, class_name = name.replace(":", ".").rpartition(".")
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+def make_bot(entry):
+    cls = get_bot_class(entry.get("bot", "bot.HQMBot"))
+    return cls(entry["host"], int(entry["port"]), int(entry["team"]), entry["name"])
+
+def run_shard(entries, stats_queue, report_interval):
+    # entries is a list of (index, entry). Stats are reported by index,
+    # since names don't have to be unique.
+    indices = [index for index, entry in entries]
+    bots = [make_bot(entry) for index, entry in entries]
+    
+    def report(bots):
+        stats = [(index, b.session.username, dict(b.stats)) for index, b in zip(indices, bots)]
+        try:
+            stats_queue.put_nowait(stats)
+        except queue.Full:
+            pass
+            
+    bot.run_bots(bots, report=report, report_interval=report_interval)
+    report(bots)
+
+def print_stats(all_stats):
+    format = "{:<20}{:>8}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}"
+    print(format.format("NAME", "TICKS", "PACKETS", "DROPPED", "OVERRUNS", "ACT MS", "ACT MAX", "LATE MS"))
+    totals = {"ticks": 0, "packets": 0, "dropped": 0, "overruns": 0,
+              "action_time": 0.0, "action_max": 0.0, "late_time": 0.0}
+    for index in sorted(all_stats):
+        name, stats = all_stats[index]
+        ticks = max(1, stats["ticks"])
+        print(format.format(name, stats["ticks"], stats["packets"], stats["dropped"], stats["overruns"],
+            "{:.3f}".format(stats["action_time"]*1000/ticks),
+            "{:.3f}".format(stats["action_max"]*1000),
+            "{:.3f}".format(stats["late_time"]*1000/ticks)))
+        for key in totals:
+            if key == "action_max":
+                totals[key] = max(totals[key], stats[key])
+            else:
+                totals[key] += stats[key]
+    ticks = max(1, totals["ticks"])
+    print(format.format("TOTAL", totals["ticks"], totals["packets"], totals["dropped"], totals["overruns"],
+        "{:.3f}".format(totals["action_time"]*1000/ticks),
+        "{:.3f}".format(totals["action_max"]*1000),
+        "{:.3f}".format(totals["late_time"]*1000/ticks)))
+    sys.stdout.flush()
+
+def run_fleet(entries, processes=None, report_interval=5.0):
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(entries)))
+    indexed = list(enumerate(entries))
+    shards = [indexed[i::processes] for i in range(processes)]
+    stats_queue = multiprocessing.Queue(1000)
+    workers = []
+    for shard in shards:
+        worker = multiprocessing.Process(target=run_shard, args=(shard, stats_queue, report_interval))
+        worker.start()
+        workers.append(worker)
+    all_stats = {}
+    next_print = time.monotonic() + report_interval
+    try:
+        while any(worker.is_alive() for worker in workers):
+            try:
+                for index, name, stats in stats_queue.get(timeout=0.5):
+                    all_stats[index] = (name, stats)
+            except queue.Empty:
+                pass
+            if time.monotonic() >= next_print and all_stats:
+                print_stats(all_stats)
+                next_print += report_interval
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too, and they send exit messages before
+        # they stop. Workers that weren't interrupted are asked to stop here.
+        for worker in workers:
+            worker.join(2)
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+                worker.join(2)
+            if worker.is_alive():
+                worker.terminate()
+    while True:
+        try:
+            for index, name, stats in stats_queue.get_nowait():
+                all_stats[index] = (name, stats)
+        except queue.Empty:
+            break
+    if all_stats:
+        print_stats(all_stats)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args)==0:
+        print_help()
+        sys.exit(1)
+    try:
+        processes = int(args[args.index("-p")+1]) if "-p" in args else None
+        interval = float(args[args.index("-i")+1]) if "-i" in args else 5.0
+    except (ValueError, IndexError):
+        print_help()
+        sys.exit(1)
+    run_fleet(load_config(args[0]), processes, interval)
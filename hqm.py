@@ -7,6 +7,7 @@ from bitparse import CSBitWriter
 from collections import deque
 import struct
 import math
+import time
  
 header = b"Hock"
 server_list_message = b"Hock!"
@@ -20,6 +21,14 @@ SCMD_INFO_RESPONSE = 1
 SCMD_GAME_UPDATE = 5
 SCMD_NEW_MATCH = 6
 
+# Rink geometry in meters. x goes across the rink, z along it and y is up.
+rink_width = 30
+rink_length = 61
+rink_corner_radius = 8.5
+# Goal line corners of the nets, as (x, z). The red net is the one the red team defends.
+red_net = ((13.5, 57), (13.5, 58), (16.5, 58), (16.5, 57))
+blue_net = ((13.5, 4), (13.5, 3), (16.5, 3), (16.5, 4))
+
 def string_strip_null(str):
     firstZero = str.find(0)
     if firstZero != -1:
@@ -42,54 +51,21 @@ def convert_unknown_rot(rot):
     return (rot-16384)/8192
     
     
-try:
-    import numpy as np
-    pi = math.pi
-    
-    unitVectors = [
-        np.array(( 0, -1,  0), dtype=np.float32),
-        np.array((-1,  0,  0), dtype=np.float32),
-        np.array(( 0,  0, -1), dtype=np.float32),
-        np.array(( 1,  0,  0), dtype=np.float32),
-        np.array(( 0,  0,  1), dtype=np.float32),
-        np.array(( 0,  1,  0), dtype=np.float32)
-    ]
-    
-    vChoice1 = [5,5,5,5,4,1,3,2]
-    vChoice2 = [3,4,2,1,3,4,2,1]
-    vChoice3 = [4,1,3,2,0,0,0,0]
+pi = math.pi
+tick_rate = 100 # The server runs 100 simulation steps per second
 
-    def convert_rot_vector(n, bits):
-        if n is None:
-            return None
-
-        lowest = n & 0x7
-        a1 = unitVectors[vChoice1[lowest]]
-        a2 = unitVectors[vChoice2[lowest]]
-        a3 = unitVectors[vChoice3[lowest]]
-        for i in range(3, bits, 2):
-            c = (n >> i) & 3 # Two bits at a time
+# Names that are loaded from hqmgeometry the first time they are used
+geometry_names = ("unitVectors", "vChoice1", "vChoice2", "vChoice3", "unitVectorArray",
+                  "convert_rot_vector", "convert_rot_vectors")
 
-            res = np.array((a1+a2,a2+a3,a1+a3))
-            res /= np.linalg.norm(res, axis=1)
-            if c==0:
-                a2 = res[0]
-                a3 = res[2]
-            elif c==1:
-                a1 = res[0]         
-                a3 = res[1]
-            elif c==2:
-                a2 = res[1]     
-                a1 = res[2]
-            elif c==3:
-                a1 = res[0]    # a1' = vector between a1 and a2
-                a2 = res[1]    # a2' = vector between a2 and a3
-                a3 = res[2]    # a3' = vector between a1 and a3
-        res = a1+a2+a3
-        res /= np.linalg.norm(res)
-        return res 
-except ImportError:
-    pass # No numpy
+def __getattr__(name):
+    if name in geometry_names:
+        try:
+            import hqmgeometry
+        except ImportError: # No numpy
+            raise AttributeError("module 'hqm' has no attribute '{}'".format(name))
+        return getattr(hqmgeometry, name)
+    raise AttributeError("module 'hqm' has no attribute '{}'".format(name))
     
        
 
@@ -140,9 +116,16 @@ def make_info_request_cmessage(version, ping):
     bw.write_unsigned(32, ping) # Value is used for ping calculations
     return bw.get_bytes()
     
-def update_player_list(list, msg):
+def update_player_list(list, msg, object_players=None):
+    # object_players, if given, maps object indices to player indices and is
+    # kept up to date with the list
     if msg["type"] == "JOIN":
         old_player_obj = list.get(msg["player"])
+        if object_players is not None:
+            if old_player_obj and object_players.get(old_player_obj["obj"]) == msg["player"]:
+                del object_players[old_player_obj["obj"]]
+            if msg["offset"] != -1:
+                object_players[msg["offset"]] = msg["player"]
         player_obj = {}
         player_obj["team"] = msg["team"]
         player_obj["name"] = msg["name"]
@@ -156,7 +139,9 @@ def update_player_list(list, msg):
             player_obj["assist"] = 0
         list[msg["player"]] = player_obj
     elif msg["type"] == "EXIT":
-        del list[msg["player"]]
+        old_player_obj = list.pop(msg["player"])
+        if object_players is not None and object_players.get(old_player_obj["obj"]) == msg["player"]:
+            del object_players[old_player_obj["obj"]]
     elif msg["type"] == "GOAL":
         scoring = list.get(msg["scoring_player"])
         assisting = list.get(msg["assisting_player"])
@@ -184,12 +169,54 @@ class HQMGameState:
         self.you = None
         self.objects = {}
         self.players = {}
+        self.object_players = {} # Object index to player index
         self.events = []
+        # Objects of the snapshot before this one, used for velocities
+        self.previous_objects = None
+        self.previous_simstep = None
+        self._world = None
         
     def copy_state(self, other):
         if other:
             self.players = other.players.copy()
+            self.object_players = other.object_players.copy()
             self.events = other.events[:]
+            self.previous_objects = other.objects
+            self.previous_simstep = other.simstep
+            
+    def object_player(self, i):
+        # The player controlling object i, or None
+        player_index = self.object_players.get(i)
+        if player_index is None:
+            return None
+        return self.players.get(player_index)
+        
+    def calculate_positions(self):
+        # Same as calculate_positions on every object, but the rotations of
+        # all of them are decoded at once
+        objects = [obj for obj in self.objects.values() if not obj.calculated]
+        if not objects:
+            return
+        from hqmgeometry import convert_rot_vectors
+        rot_vectors = convert_rot_vectors(
+            [(obj["rot_a_int"] or 0, obj["rot_b_int"] or 0) for obj in objects], 31)
+        players = [obj for obj in objects if obj["type"] == "PLAYER"]
+        if players:
+            stick_rot_vectors = convert_rot_vectors(
+                [(obj["stick_rot_a_int"] or 0, obj["stick_rot_b_int"] or 0) for obj in players], 25)
+        stick_rows = {id(obj): row for row, obj in enumerate(players)}
+        for row, obj in enumerate(objects):
+            stick_row = stick_rows.get(id(obj))
+            obj.calculate_positions(rot_vectors[row],
+                                    None if stick_row is None else stick_rot_vectors[stick_row])
+        
+    @property
+    def world(self):
+        # Computed on first use and then shared by everyone using this snapshot
+        if self._world is None:
+            import hqmworld
+            self._world = hqmworld.HQMWorldModel(self)
+        return self._world
         
 
         
@@ -198,9 +225,12 @@ class HQMObjectState(dict):
         dict.__init__(self)
         self.calculated = False
     
-    def calculate_positions(self):
+    def calculate_positions(self, rot_vectors=None, stick_rot_vectors=None):
+        # rot_vectors and stick_rot_vectors are the two decoded rotation
+        # vectors, if they have been decoded already
         if not self.calculated:
             import numpy as np
+            from hqmgeometry import convert_rot_vector
             self.calculated = True
             pos_x = convert_pos(self["pos_x_int"])
             pos_y = convert_pos(self["pos_y_int"])
@@ -208,8 +238,13 @@ class HQMObjectState(dict):
             
             self["pos"] = np.array((pos_x, pos_y, pos_z), dtype=np.float32)
             
-            rot_2 = convert_rot_vector(self["rot_a_int"], 31)
-            rot_3 = convert_rot_vector(self["rot_b_int"], 31)
+            if self["rot_a_int"] is None or self["rot_b_int"] is None:
+                rot_2 = rot_3 = None
+            elif rot_vectors is not None:
+                rot_2, rot_3 = rot_vectors
+            else:
+                rot_2 = convert_rot_vector(self["rot_a_int"], 31)
+                rot_3 = convert_rot_vector(self["rot_b_int"], 31)
             if rot_2 is not None and rot_3 is not None:
                 rot_1 = np.cross(rot_2, rot_3)
                 self["rot"] = np.column_stack((rot_1, rot_2, rot_3))
@@ -224,8 +259,13 @@ class HQMObjectState(dict):
                     
                 self["stick_pos"] = np.array((stick_x, stick_y, stick_z), dtype=np.float32)    
                     
-                stick_rot_2 = convert_rot_vector(self["stick_rot_a_int"], 25)
-                stick_rot_3 = convert_rot_vector(self["stick_rot_b_int"], 25)
+                if self["stick_rot_a_int"] is None or self["stick_rot_b_int"] is None:
+                    stick_rot_2 = stick_rot_3 = None
+                elif stick_rot_vectors is not None:
+                    stick_rot_2, stick_rot_3 = stick_rot_vectors
+                else:
+                    stick_rot_2 = convert_rot_vector(self["stick_rot_a_int"], 25)
+                    stick_rot_3 = convert_rot_vector(self["stick_rot_b_int"], 25)
                 if stick_rot_2 is not None and stick_rot_3 is not None:
                     stick_rot_1 = np.cross(stick_rot_2, stick_rot_3)
                     self["stick_rot"] = np.column_stack((stick_rot_1, stick_rot_2, stick_rot_3))
@@ -243,6 +283,12 @@ def bitmask_set(num, mask, val):
         
 
 class HQMClientSession:
+    # Classes used for decoding. enable_stats() replaces them on the
+    # instance with instrumented ones.
+    reader_class = CSBitReader
+    gamestate_class = HQMGameState
+    object_class = HQMObjectState
+    
     def __init__(self, username, version):
         self.username = username
         self.version = version
@@ -260,10 +306,50 @@ class HQMClientSession:
         self.head_rot = 0
         self.body_rot = 0
         self.keys = 0
+        # If False, chat messages are stored without their text, which
+        # speeds up catching up with a long message backlog
+        self.decode_chat = True
+        # An optional hqmhistory.HQMSnapshotHistory that gets every new gamestate
+        self.history = None
+        # Game updates that arrive ahead of a missing one can be held back
+        # for up to reorder_window packets or reorder_delay seconds, waiting
+        # for the missing one, and then applied in order. 0 turns this off.
+        self.reorder_window = 0
+        self.reorder_delay = 0.05
+        self.reorder_buffer = {} # cur_packet -> (arrival time, simstep, message)
+        self.reorder_stats = {
+            "reordered": 0, # Arrived after a later packet but was applied in order
+            "late": 0,      # Arrived after a later packet had already been applied
+            "dropped": 0,   # Never arrived while it was waited for
+            "duplicate": 0
+        }
+        # An hqmstats.HQMSessionStats while stats are enabled
+        self.instrumentation = None
+        # An optional hqmnet.HQMNetworkStats that is told about every game
+        # update that arrives and every ack that is sent
+        self.network = None
              
     def add_chat(self, str):
         self.chat_messages.append(str)
         
+    def enable_stats(self):
+        # Starts recording timings and counts of the decoding stages. When
+        # stats are off nothing is recorded and decoding runs as usual.
+        if self.instrumentation is None:
+            import hqmstats
+            self.instrumentation = hqmstats.HQMSessionStats(self)
+            
+    def disable_stats(self):
+        if self.instrumentation is not None:
+            self.instrumentation.remove()
+            self.instrumentation = None
+            
+    def stats(self):
+        # A snapshot of the recorded stats, or None if they are not enabled
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.snapshot()
+        
     @property
     def jump(self):
         return self.keys & 0x1 > 0
@@ -321,6 +407,8 @@ class HQMClientSession:
             bw.write_unsigned_aligned(32, self.keys) 
             if self.gamestate:
                 bw.write_unsigned_aligned(32, self.gamestate.packet) # Last read packet
+                if self.network is not None:
+                    self.network.on_sent(self.gamestate.packet)
                 bw.write_unsigned_aligned(16, self.gamestate.msg_pos) # Last received message
             else:
                 bw.write_unsigned_aligned(32, -1) 
@@ -344,7 +432,7 @@ class HQMClientSession:
         return bw.get_bytes()
         
     def parse_message(self, message):
-        br = CSBitReader(message)
+        br = self.reader_class(message)
         if br.read_bytes_aligned(4) != header:
             return None
         type = br.read_unsigned_aligned(8)
@@ -354,12 +442,88 @@ class HQMClientSession:
             if self.gamestate is None or self.gamestate.id != gameID:
                 self.last_game_id = gameID
                 self.gamestate = None
+                self.reorder_buffer.clear()
         elif type == SCMD_GAME_UPDATE:
-            self.parse_game_update(br)          
+            if self.network is not None:
+                self.network.on_received(*self.peek_game_update(message))
+            if self.reorder_window > 0:
+                self.reorder_game_update(message)
+            else:
+                self.parse_game_update(br)          
         else:
             # Unknown type
             return None
         return self.gamestate
+        
+    def peek_game_update(self, message):
+        # Returns (game id, simstep, packet, acked packet) of a game update
+        # without decoding it
+        br = self.reader_class(message)
+        br.skip(40) # Header and type
+        gameID = br.read_unsigned_aligned(32)
+        simstep = br.read_unsigned_aligned(32)
+        br.skip(1+8+8+16+16+8+8)
+        packet = br.read_unsigned_aligned(32)
+        old_packet = br.read_unsigned_aligned(32)
+        return gameID, simstep, packet, old_packet
+        
+    def apply_game_update(self, message):
+        br = self.reader_class(message)
+        br.skip(40)
+        self.parse_game_update(br)
+        
+    def reorder_game_update(self, message):
+        gameID, simstep, packet, old_packet = self.peek_game_update(message)
+        if gameID != self.last_game_id:
+            return
+        stats = self.reorder_stats
+        if self.gamestate is None:
+            self.apply_game_update(message)
+        else:
+            expected = self.gamestate.packet + 1
+            if packet < expected:
+                if packet == self.gamestate.packet:
+                    stats["duplicate"] += 1
+                else:
+                    stats["late"] += 1
+                return
+            elif packet == expected:
+                if self.reorder_buffer:
+                    stats["reordered"] += 1
+                self.apply_game_update(message)
+            elif packet in self.reorder_buffer:
+                stats["duplicate"] += 1
+                return
+            else:
+                self.reorder_buffer[packet] = (time.monotonic(), simstep, message)
+        self.flush_reorder_buffer()
+        
+    def reorder_deadline(self):
+        # The monotonic time when flush_reorder_buffer stops waiting for the
+        # missing packets, or None if nothing is held back
+        if not self.reorder_buffer:
+            return None
+        return min(arrival for arrival, simstep, message in self.reorder_buffer.values()) + self.reorder_delay
+        
+    def flush_reorder_buffer(self, force=False):
+        # Applies held back updates that are next in line. If the buffer is
+        # full or has waited too long, the missing packets are given up on.
+        # Receive loops call it at reorder_deadline() too, so that updates
+        # aren't held back when no more packets arrive.
+        buffer = self.reorder_buffer
+        now = time.monotonic()
+        while buffer and self.gamestate is not None:
+            packet = min(buffer)
+            expected = self.gamestate.packet + 1
+            arrival, simstep, message = buffer[packet]
+            if packet > expected:
+                waited = now - arrival
+                if not force and len(buffer) <= self.reorder_window and waited < self.reorder_delay:
+                    break
+                self.reorder_stats["dropped"] += packet - expected
+            del buffer[packet]
+            if packet >= expected:
+                self.apply_game_update(message)
             
     def parse_game_update(self, br):
         gameID = br.read_unsigned_aligned(32)
@@ -369,7 +533,7 @@ class HQMClientSession:
         if self.gamestate:
             if simstep<self.gamestate.simstep and self.gamestate.simstep-simstep<100:
                 return
-        new_gamestate = HQMGameState(gameID)
+        new_gamestate = self.gamestate_class(gameID)
         new_gamestate.copy_state(self.gamestate)
         new_gamestate.simstep = simstep
         new_gamestate.gameover = br.read_unsigned(1)
@@ -382,6 +546,8 @@ class HQMClientSession:
         self.parse_objects(br, new_gamestate)
         self.parse_messages(br, new_gamestate)
         self.gamestate = new_gamestate
+        if self.history is not None:
+            self.history.push(new_gamestate)
 
     def parse_objects(self, br, new_gamestate):
         cur_packet = br.read_unsigned_aligned(32)
@@ -400,7 +566,7 @@ class HQMClientSession:
         else:
             old_obj = self.saved_states[old_packet][i]    
         
-        obj = HQMObjectState()
+        obj = self.object_class()
         ingame = br.read_unsigned(1) == 1
         if not ingame:
             return
@@ -439,10 +605,11 @@ class HQMClientSession:
         old_msg_pos = self.gamestate.msg_pos if self.gamestate else 0
         msg_pos     = br.read_unsigned(16) 
         for i in range(msg_pos, msg_pos+message_num): 
-            msg = self.parse_state_message(br)
             if i < old_msg_pos:
+                self.skip_state_message(br) # Already seen
                 continue          
-            update_player_list(new_gamestate.players, msg)
+            msg = self.parse_state_message(br)
+            update_player_list(new_gamestate.players, msg, new_gamestate.object_players)
             new_gamestate.events.append(msg)
         new_gamestate.msg_pos = max(old_msg_pos, msg_pos+message_num)
         
@@ -474,12 +641,27 @@ class HQMClientSession:
             msg["player"] = br.read_unsigned_or_minus_one(6)
             msg["size"] = br.read_unsigned(6)
             #print(msg["size"])
+            if not self.decode_chat:
+                br.skip(msg["size"]*7)
+                msg["message"] = None
+                return msg
             name = []
             for i in range(msg["size"]):
                 name.append(br.read_unsigned(7))
             name = bytes(name)
             msg["message"] = string_strip_null(name).decode("ascii", "ignore")
         return msg
+        
+    def skip_state_message(self, br):
+        type = br.read_unsigned(6)
+        if type == 0:
+            br.skip(6+1+2+6+31*7)
+        elif type == 1:
+            br.skip(2+6+6)
+        elif type == 2:
+            br.skip(6)
+            size = br.read_unsigned(6)
+            br.skip(size*7)
     
         
         
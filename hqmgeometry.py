@@ -0,0 +1,77 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+# Rotation decoding, which needs numpy. It is kept out of hqm so that
+# importing hqm stays fast for tools that never look at object positions.
+
+import numpy as np
+
+unitVectors = [
+    np.array(( 0, -1,  0), dtype=np.float32),
+    np.array((-1,  0,  0), dtype=np.float32),
+    np.array(( 0,  0, -1), dtype=np.float32),
+    np.array(( 1,  0,  0), dtype=np.float32),
+    np.array(( 0,  0,  1), dtype=np.float32),
+    np.array(( 0,  1,  0), dtype=np.float32)
+]
+
+vChoice1 = [5,5,5,5,4,1,3,2]
+vChoice2 = [3,4,2,1,3,4,2,1]
+vChoice3 = [4,1,3,2,0,0,0,0]
+
+def convert_rot_vector(n, bits):
+    if n is None:
+        return None
+
+    lowest = n & 0x7
+    a1 = unitVectors[vChoice1[lowest]]
+    a2 = unitVectors[vChoice2[lowest]]
+    a3 = unitVectors[vChoice3[lowest]]
+    for i in range(3, bits, 2):
+        c = (n >> i) & 3 # Two bits at a time
+
+        res = np.array((a1+a2,a2+a3,a1+a3))
+        res /= np.linalg.norm(res, axis=1)
+        if c==0:
+            a2 = res[0]
+            a3 = res[2]
+        elif c==1:
+            a1 = res[0]         
+            a3 = res[1]
+        elif c==2:
+            a2 = res[1]     
+            a1 = res[2]
+        elif c==3:
+            a1 = res[0]    # a1' = vector between a1 and a2
+            a2 = res[1]    # a2' = vector between a2 and a3
+            a3 = res[2]    # a3' = vector between a1 and a3
+    res = a1+a2+a3
+    res /= np.linalg.norm(res)
+    return res 
+    
+unitVectorArray = np.array(unitVectors)
+
+def convert_rot_vectors(n, bits):
+    # Same as convert_rot_vector, for an array of values at once
+    n = np.asarray(n, dtype=np.int64)
+    lowest = n & 0x7
+    a1 = unitVectorArray[np.take(vChoice1, lowest)]
+    a2 = unitVectorArray[np.take(vChoice2, lowest)]
+    a3 = unitVectorArray[np.take(vChoice3, lowest)]
+    for i in range(3, bits, 2):
+        c = ((n >> i) & 3)[..., np.newaxis]
+        a12 = a1+a2
+        a23 = a2+a3
+        a13 = a1+a3
+        # Divided the same way as res in convert_rot_vector
+        norms = np.stack((np.linalg.norm(a12, axis=-1), np.linalg.norm(a23, axis=-1),
+                          np.linalg.norm(a13, axis=-1)), axis=-1)
+        a12 /= norms
+        a23 /= norms
+        a13 /= norms
+        a1, a2, a3 = (np.where((c==1) | (c==3), a12, np.where(c==2, a13, a1)),
+                      np.where(c==0, a12, np.where(c>=2, a23, a2)),
+                      np.where((c==0) | (c==3), a13, np.where(c==1, a23, a3)))
+    res = a1+a2+a3
+    return res / np.linalg.norm(res, axis=-1, keepdims=True)
@@ -0,0 +1,128 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import time
+import numpy as np
+import hqm
+import hqmgeometry
+from hqmworld import object_positions
+
+class HQMSnapshotHistory:
+    # The last size snapshots of a game, ordered by simstep, stored in arrays.
+    # Set it as session.history and the session fills it as updates arrive.
+    # Positions and rotations at any simstep, including fractional ones, are
+    # found by interpolating between snapshots, or by extrapolating from the
+    # last two up to max_extrapolation steps ahead.
+    def __init__(self, size=32, max_extrapolation=20, object_count=32):
+        self.size = size
+        self.max_extrapolation = max_extrapolation
+        self.simsteps = np.zeros(size, dtype=np.int64)
+        self.arrivals = np.zeros(size)
+        self.present = np.zeros((size, object_count), dtype=bool)
+        self.positions = np.full((size, object_count, 3), np.nan, dtype=np.float32)
+        self.rot_ints = np.zeros((size, object_count, 2), dtype=np.int64)
+        # Rotation vectors are only decoded for snapshots that are sampled
+        self.rot_vectors = np.zeros((size, object_count, 2, 3), dtype=np.float32)
+        self.rot_decoded = np.zeros(size, dtype=bool)
+        self.game_id = None
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.head = 0 # Where the next snapshot goes
+        self.present[:] = False
+        self.rot_decoded[:] = False
+
+    def __len__(self):
+        return self.count
+
+    def order(self):
+        # Rows from oldest to newest
+        return (self.head - self.count + np.arange(self.count)) % self.size
+
+    @property
+    def latest_simstep(self):
+        if self.count == 0:
+            return None
+        return int(self.simsteps[(self.head - 1) % self.size])
+
+    def push(self, gamestate, arrival=None):
+        if arrival is None:
+            arrival = time.monotonic()
+        if gamestate.id != self.game_id:
+            self.game_id = gamestate.id
+            self.clear()
+        latest = self.latest_simstep
+        if latest is not None and gamestate.simstep <= latest:
+            return False
+        row = self.head
+        self.simsteps[row] = gamestate.simstep
+        self.arrivals[row] = arrival
+        self.present[row] = False
+        self.positions[row] = np.nan
+        self.rot_ints[row] = 0
+        self.rot_decoded[row] = False
+        indices = list(gamestate.objects)
+        self.positions[row, indices] = object_positions(gamestate.objects, indices)
+        for i, obj in gamestate.objects.items():
+            self.present[row, i] = True
+            rot_a = obj["rot_a_int"]
+            rot_b = obj["rot_b_int"]
+            if rot_a is None or rot_b is None:
+                self.present[row, i] = False
+                continue
+            self.rot_ints[row, i] = rot_a, rot_b
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        return True
+
+    def render_simstep(self, now=None, delay=0.05):
+        # The simstep to show at the monotonic time now, delay seconds behind
+        # the newest snapshot so that there is usually something to interpolate to
+        if self.count == 0:
+            return None
+        if now is None:
+            now = time.monotonic()
+        row = (self.head - 1) % self.size
+        return self.simsteps[row] + (now - self.arrivals[row] - delay) * hqm.tick_rate
+
+    def _rot_vectors(self, row):
+        if not self.rot_decoded[row]:
+            self.rot_vectors[row] = hqmgeometry.convert_rot_vectors(self.rot_ints[row], 31)
+            self.rot_decoded[row] = True
+        return self.rot_vectors[row]
+
+    def sample(self, simstep, rotations=True):
+        # Returns (present, positions, rotations) at simstep. present is a
+        # boolean array telling which objects exist, positions an array of
+        # shape (objects, 3) and rotations an array of shape (objects, 3, 3)
+        # built like HQMObjectState's "rot", or None if rotations is False.
+        if self.count == 0:
+            return None
+        order = self.order()
+        simsteps = self.simsteps[order]
+        if self.count == 1 or simstep <= simsteps[0]:
+            a = b = order[0] if simstep <= simsteps[0] else order[-1]
+            t = 0.0
+        elif simstep >= simsteps[-1]:
+            # Extrapolate from the last two snapshots
+            a, b = order[-2], order[-1]
+            ahead = min(simstep - simsteps[-1], self.max_extrapolation)
+            t = 1 + ahead / (simsteps[-1] - simsteps[-2])
+        else:
+            pos = np.searchsorted(simsteps, simstep, side="right")
+            a, b = order[pos-1], order[pos]
+            t = (simstep - simsteps[pos-1]) / (simsteps[pos] - simsteps[pos-1])
+        present = self.present[a] & self.present[b]
+        positions = self.positions[a] + (self.positions[b] - self.positions[a]) * t
+        if not rotations:
+            return present, positions, None
+        vectors_a = self._rot_vectors(a)
+        vectors_b = self._rot_vectors(b)
+        vectors = vectors_a + (vectors_b - vectors_a) * t
+        vectors /= np.linalg.norm(vectors, axis=-1, keepdims=True)
+        rot_2 = vectors[:, 0]
+        rot_3 = vectors[:, 1]
+        rot_1 = np.cross(rot_2, rot_3)
+        return present, positions, np.stack((rot_1, rot_2, rot_3), axis=-1)
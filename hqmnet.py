@@ -0,0 +1,116 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import time
+import hqm
+
+class HQMNetworkStats:
+    # Connection quality of a session, measured from the packet numbers and
+    # simsteps of game updates and the acks the session sends.
+    # Set it as session.network and the session reports to it.
+    #
+    # Every update carries its own packet number and the number of the last
+    # packet the server knows the client received (the ack the client sent).
+    # The time from sending an ack until an update based on it arrives is the
+    # round trip time plus however long the server waited before sending.
+    def __init__(self, window=1024, rtt_gain=1/8, jitter_gain=1/16):
+        self.window = window # How far back duplicates are recognized
+        self.rtt_gain = rtt_gain
+        self.jitter_gain = jitter_gain
+        self.game_id = None
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.first_packet = None
+        self.max_packet = None
+        self.seen = set()
+        self.jitter = 0.0
+        self.last_arrival = None
+        self.last_simstep = None
+        self.first_arrival = None
+        self.first_simstep = None
+        self.max_simstep = None
+        self.max_simstep_arrival = None
+        self.ack_times = {} # Packet number -> when it was first acked
+        self.acked = None   # Newest ack the server has used
+        self.rtt = None     # Smoothed
+        self.rtt_min = None
+        self.rtt_samples = 0
+
+    def on_received(self, game_id, simstep, packet, old_packet, arrival=None):
+        if arrival is None:
+            arrival = time.monotonic()
+        if game_id != self.game_id:
+            self.game_id = game_id
+            self.reset()
+        if packet in self.seen:
+            self.duplicates += 1
+            return
+        self.received += 1
+        self.seen.add(packet)
+        if self.first_packet is None:
+            self.first_packet = self.max_packet = packet
+            self.first_arrival = self.max_simstep_arrival = arrival
+            self.first_simstep = self.max_simstep = simstep
+        elif packet < self.max_packet:
+            self.reordered += 1
+            self.first_packet = min(self.first_packet, packet)
+        else:
+            self.max_packet = packet
+            if len(self.seen) > 2*self.window:
+                self.seen = {seen for seen in self.seen if seen > packet - self.window}
+
+        # Interarrival jitter as in RTP, with the simstep as the send time
+        if self.last_arrival is not None:
+            difference = (arrival - self.last_arrival) - (simstep - self.last_simstep) / hqm.tick_rate
+            self.jitter += (abs(difference) - self.jitter) * self.jitter_gain
+        self.last_arrival = arrival
+        self.last_simstep = simstep
+        if simstep > self.max_simstep:
+            self.max_simstep = simstep
+            self.max_simstep_arrival = arrival
+
+        if old_packet in self.ack_times and (self.acked is None or old_packet > self.acked):
+            sample = arrival - self.ack_times[old_packet]
+            self.acked = old_packet
+            self.ack_times = {acked: sent for acked, sent in self.ack_times.items() if acked > old_packet}
+            self.rtt_samples += 1
+            if self.rtt is None:
+                self.rtt = sample
+            else:
+                self.rtt += (sample - self.rtt) * self.rtt_gain
+            if self.rtt_min is None or sample < self.rtt_min:
+                self.rtt_min = sample
+
+    def on_sent(self, packet, now=None):
+        # The session acked packet in an update sent now
+        if packet in self.ack_times or (self.acked is not None and packet <= self.acked):
+            return
+        self.ack_times[packet] = time.monotonic() if now is None else now
+
+    def snapshot(self):
+        # Rates are parts of the expected packets, times are in seconds
+        expected = 0 if self.first_packet is None else self.max_packet - self.first_packet + 1
+        lost = max(expected - self.received, 0)
+        duration = 0 if self.first_arrival is None else self.max_simstep_arrival - self.first_arrival
+        return {
+            "received": self.received,
+            "expected": expected,
+            "lost": lost,
+            "loss": lost / expected if expected else 0.0,
+            "duplicates": self.duplicates,
+            "duplicate_rate": self.duplicates / expected if expected else 0.0,
+            "reordered": self.reordered,
+            "reorder_rate": self.reordered / expected if expected else 0.0,
+            "jitter": self.jitter,
+            "rtt": self.rtt,
+            "rtt_min": self.rtt_min,
+            "rtt_samples": self.rtt_samples,
+            # Simsteps and updates per second of wall time
+            "tick_rate": (self.max_simstep - self.first_simstep) / duration if duration > 0 else None,
+            "update_rate": (self.received - 1) / duration if duration > 0 else None
+        }
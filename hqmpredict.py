@@ -0,0 +1,175 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import numpy as np
+import hqm
+
+# Physics, per simulation step (1/100 s). These are estimates from watching
+# pucks, not the exact values used by the server.
+gravity = 0.000680
+puck_radius = 0.125
+puck_height = 0.0413   # Height of the puck center when it lies on the ice
+ice_friction = 0.0015  # Part of the horizontal speed lost each step on the ice
+ice_restitution = 0.2
+board_restitution = 0.6
+net_restitution = 0.3
+net_height = 1.0
+
+def net_box(net):
+    xs = [x for x, z in net]
+    zs = [z for x, z in net]
+    min_z, max_z = min(zs), max(zs)
+    # The goal line is the side of the net facing the center of the rink
+    if abs(min_z - hqm.rink_length/2) < abs(max_z - hqm.rink_length/2):
+        goal_line, direction = min_z, 1
+    else:
+        goal_line, direction = max_z, -1
+    return min(xs), max(xs), min_z, max_z, goal_line, direction
+
+# Index 0 is the red net, index 1 the blue net
+nets = (net_box(hqm.red_net), net_box(hqm.blue_net))
+
+def estimate_velocity(snapshots, i, max_snapshots=5):
+    # Estimates the velocity of object i in meters per step from a list of
+    # HQMGameState snapshots, oldest first, with a least squares fit over the
+    # last max_snapshots. A single snapshot uses its own world model velocity.
+    if isinstance(snapshots, hqm.HQMGameState):
+        snapshots = [snapshots]
+    times = []
+    positions = []
+    for gamestate in snapshots[-max_snapshots:]:
+        if i not in gamestate.objects:
+            continue
+        pos = gamestate.world.position(i)
+        if np.any(np.isnan(pos)):
+            continue
+        times.append(gamestate.simstep)
+        positions.append(pos)
+    if len(set(times)) < 2:
+        velocity = snapshots[-1].world.velocity(i) if i in snapshots[-1].objects else None
+        if velocity is None or np.any(np.isnan(velocity)):
+            return np.zeros(3)
+        return velocity.astype(np.float64)
+    times = np.array(times, dtype=np.float64)
+    positions = np.array(positions, dtype=np.float64)
+    times -= times.mean()
+    positions -= positions.mean(axis=0)
+    return times @ positions / (times @ times)
+
+def simulate(positions, velocities, ticks, step_size=1):
+    # Moves any number of pucks forward at once. positions and velocities are
+    # arrays of shape (n, 3). Returns (path, in_net) where path has the shape
+    # (steps+1, n, 3), with one entry every step_size ticks, and in_net is the
+    # net each puck ended up in: 0 (red), 1 (blue) or -1.
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    velocities = np.asarray(velocities, dtype=np.float64).reshape(-1, 3)
+    # One contiguous array per coordinate is faster than columns of an (n, 3) array
+    x, y, z = [positions[:, i].copy() for i in range(3)]
+    vx, vy, vz = [velocities[:, i].copy() for i in range(3)]
+    count = len(x)
+    steps = -(-ticks // step_size)
+    path = np.empty((steps+1, 3, count))
+    path[0] = x, y, z
+    in_net = np.full(count, -1, dtype=np.int8)
+    stopped = np.zeros(count, dtype=bool)
+    has_stopped = False
+
+    dt = step_size
+    friction = (1 - ice_friction) ** dt
+    r = hqm.rink_corner_radius
+    low = puck_radius
+    high_x = hqm.rink_width - puck_radius
+    high_z = hqm.rink_length - puck_radius
+    corner_x = (r, hqm.rink_width - r)
+    corner_z = (r, hqm.rink_length - r)
+    for step in range(1, steps+1):
+        old_z = z.copy()
+        vy -= gravity * dt
+        x += vx * dt
+        y += vy * dt
+        z += vz * dt
+
+        # Ice
+        on_ice = y <= puck_height
+        np.maximum(y, puck_height, out=y)
+        vy[:] = np.where(on_ice & (vy < 0), vy * -ice_restitution, vy)
+        slow = np.where(on_ice, friction, 1.0)
+        vx *= slow
+        vz *= slow
+
+        # Straight boards, mirrored back into the rink
+        min_x, max_x, min_z, max_z = x.min(), x.max(), z.min(), z.max()
+        if min_x < low or max_x > high_x:
+            hit = (x < low) | (x > high_x)
+            x[:] = np.where(x < low, 2*low - x, np.where(x > high_x, 2*high_x - x, x))
+            vx[hit] *= -board_restitution
+        if min_z < low or max_z > high_z:
+            hit = (z < low) | (z > high_z)
+            z[:] = np.where(z < low, 2*low - z, np.where(z > high_z, 2*high_z - z, z))
+            vz[hit] *= -board_restitution
+
+        # Rounded corners, only checked when some puck is close to one
+        corner = None
+        if (min_x < corner_x[0] or max_x > corner_x[1]) and (min_z < corner_z[0] or max_z > corner_z[1]):
+            corner = ((x < corner_x[0]) | (x > corner_x[1])) & ((z < corner_z[0]) | (z > corner_z[1]))
+        if corner is not None and corner.any():
+            cx = np.clip(x[corner], *corner_x)
+            cz = np.clip(z[corner], *corner_z)
+            dx = x[corner] - cx
+            dz = z[corner] - cz
+            dist = np.hypot(dx, dz)
+            hit = dist > r - puck_radius
+            if hit.any():
+                rows = np.flatnonzero(corner)[hit]
+                nx = dx[hit] / dist[hit]
+                nz = dz[hit] / dist[hit]
+                x[rows] = cx[hit] + nx * (r - puck_radius)
+                z[rows] = cz[hit] + nz * (r - puck_radius)
+                vn = np.maximum(vx[rows]*nx + vz[rows]*nz, 0) * (1 + board_restitution)
+                vx[rows] -= vn * nx
+                vz[rows] -= vn * nz
+
+        # Nets. Entering through the goal line is a goal, anything else bounces
+        # off the side back to where it came from
+        for net, (net_min_x, net_max_x, net_min_z, net_max_z, goal_line, direction) in enumerate(nets):
+            if max_z <= net_min_z or min_z >= net_max_z:
+                continue
+            inside = (x > net_min_x) & (x < net_max_x) & (z > net_min_z) & (z < net_max_z) & (y < net_height) & ~stopped
+            if not inside.any():
+                continue
+            through_mouth = (old_z - goal_line) * direction <= 0
+            goal = inside & through_mouth
+            bounce = inside & ~through_mouth
+            in_net[goal] = net
+            stopped |= goal
+            x[bounce] -= vx[bounce] * dt
+            z[bounce] = old_z[bounce]
+            vx[bounce] *= -net_restitution
+            vz[bounce] *= -net_restitution
+            has_stopped = True
+        if has_stopped:
+            vx[stopped] = 0
+            vy[stopped] = 0
+            vz[stopped] = 0
+        path[step] = x, y, z
+    return path.transpose(0, 2, 1), in_net
+
+def predict_puck(snapshots, i, ticks, samples=0, spread=0.002, step_size=2, rng=None):
+    # Predicts where puck i will be in the coming ticks. With samples > 0,
+    # that many trajectories are rolled out with velocities spread around the
+    # estimate by a normal distribution with the standard deviation spread.
+    # Returns the same as simulate, the estimate itself is always the first path.
+    # Each step costs a few tens of microseconds for a few hundred samples, so
+    # step_size trades accuracy for time on long predictions.
+    if isinstance(snapshots, hqm.HQMGameState):
+        snapshots = [snapshots]
+    position = snapshots[-1].world.position(i).astype(np.float64)
+    velocity = estimate_velocity(snapshots, i)
+    positions = np.repeat(position[np.newaxis, :], samples+1, axis=0)
+    velocities = np.repeat(velocity[np.newaxis, :], samples+1, axis=0)
+    if samples > 0:
+        if rng is None:
+            rng = np.random.default_rng()
+        velocities[1:] += rng.normal(0, spread, (samples, 3))
+    return simulate(positions, velocities, ticks, step_size)
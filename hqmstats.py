@@ -0,0 +1,177 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import math
+import functools
+from time import perf_counter
+from bitparse import CSBitReader
+import hqm
+
+# Names of the read_pos encodings, by the 2 bit type that starts them
+pos_types = ("delta3", "delta6", "delta12", "absolute")
+
+class Histogram:
+    # Counts values in buckets that are 2**(1/4) apart, so percentiles are
+    # known to within about 20% without keeping every value. Values are
+    # multiplied by scale before bucketing, which keeps small values apart.
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        scaled = value * self.scale
+        bucket = int(math.log2(scaled) * 4) if scaled > 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        # The upper limit of the bucket the p:th percentile is in
+        if self.count == 0:
+            return None
+        target = self.count * p / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                break
+        return min(2 ** ((bucket+1)/4) / self.scale, self.max)
+
+    def snapshot(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99)
+        }
+
+class HQMStatsBitReader(CSBitReader):
+    def __init__(self, bytes, stats):
+        CSBitReader.__init__(self, bytes)
+        self.pos_types = stats.pos_types
+
+    def read_pos(self, len, old=None):
+        # Peeks at the two bits that tell the encoding and leaves the
+        # decoding to CSBitReader
+        start = self.pos
+        self.pos_types[self.read_unsigned(2)] += 1
+        self.pos = start
+        return CSBitReader.read_pos(self, len, old)
+
+class HQMStatsGameState(hqm.HQMGameState):
+    def __init__(self, id, stats):
+        hqm.HQMGameState.__init__(self, id)
+        self.stats = stats
+
+    def copy_state(self, other):
+        start = perf_counter()
+        hqm.HQMGameState.copy_state(self, other)
+        elapsed = perf_counter() - start
+        self.stats.timings["copy_state"].add(elapsed)
+        self.stats.child_time += elapsed
+
+class HQMStatsObjectState(hqm.HQMObjectState):
+    def __init__(self, stats):
+        hqm.HQMObjectState.__init__(self)
+        self.stats = stats
+
+    def calculate_positions(self, rot_vectors=None, stick_rot_vectors=None):
+        if self.calculated:
+            return
+        start = perf_counter()
+        hqm.HQMObjectState.calculate_positions(self, rot_vectors, stick_rot_vectors)
+        self.stats.timings["calculate_positions"].add(perf_counter() - start)
+
+class HQMSessionStats:
+    # Instruments an HQMClientSession by putting timed versions of its
+    # methods and classes on the instance. remove() takes them away again,
+    # so a session without stats runs the plain class methods.
+    stages = ("packet", "header", "copy_state", "parse_objects", "parse_messages",
+              "calculate_positions", "get_message")
+
+    def __init__(self, session):
+        self.session = session
+        self.timings = {stage: Histogram(1000000) for stage in self.stages}
+        self.bytes = Histogram()
+        self.objects = Histogram()
+        self.pos_types = [0, 0, 0, 0]
+        self.packets = 0
+        self.child_time = 0 # Time of the stages inside the current game update
+
+        session.reader_class = functools.partial(HQMStatsBitReader, stats=self)
+        session.gamestate_class = functools.partial(HQMStatsGameState, stats=self)
+        session.object_class = functools.partial(HQMStatsObjectState, stats=self)
+        session.parse_message = self.timed_parse_message(session.parse_message)
+        session.parse_game_update = self.timed_parse_game_update(session.parse_game_update)
+        session.parse_objects = self.timed_parse_objects(session.parse_objects)
+        session.parse_messages = self.timed("parse_messages", session.parse_messages)
+        session.get_message = self.timed("get_message", session.get_message, child=False)
+
+    def remove(self):
+        for name in ("reader_class", "gamestate_class", "object_class", "parse_message",
+                     "parse_game_update", "parse_objects", "parse_messages", "get_message"):
+            self.session.__dict__.pop(name, None)
+
+    def timed(self, stage, method, child=True):
+        histogram = self.timings[stage]
+        def wrapper(*args):
+            start = perf_counter()
+            result = method(*args)
+            elapsed = perf_counter() - start
+            histogram.add(elapsed)
+            if child:
+                self.child_time += elapsed
+            return result
+        return wrapper
+
+    def timed_parse_message(self, method):
+        histogram = self.timings["packet"]
+        def wrapper(message):
+            self.packets += 1
+            self.bytes.add(len(message))
+            start = perf_counter()
+            result = method(message)
+            histogram.add(perf_counter() - start)
+            return result
+        return wrapper
+
+    def timed_parse_game_update(self, method):
+        # The header is whatever a game update spends outside the other stages
+        histogram = self.timings["header"]
+        def wrapper(br):
+            self.child_time = 0
+            start = perf_counter()
+            method(br)
+            histogram.add(max(perf_counter() - start - self.child_time, 0))
+        return wrapper
+
+    def timed_parse_objects(self, method):
+        parse_objects = self.timed("parse_objects", method)
+        def wrapper(br, new_gamestate):
+            parse_objects(br, new_gamestate)
+            self.objects.add(len(new_gamestate.objects))
+        return wrapper
+
+    def snapshot(self):
+        # Times are in seconds
+        return {
+            "packets": self.packets,
+            "bytes": self.bytes.snapshot(),
+            "objects": self.objects.snapshot(),
+            "timings": {stage: histogram.snapshot() for stage, histogram in self.timings.items()},
+            "pos_types": dict(zip(pos_types, self.pos_types))
+        }
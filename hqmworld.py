@@ -0,0 +1,115 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import numpy as np
+
+def object_positions(objects, indices):
+    # Object positions straight from the integer fields, without the
+    # rotation math in HQMObjectState.calculate_positions.
+    # Unknown positions are NaN.
+    result = np.full((len(indices), 3), np.nan, dtype=np.float32)
+    for row, i in enumerate(indices):
+        obj = objects.get(i)
+        if obj is None:
+            continue
+        for col, key in enumerate(("pos_x_int", "pos_y_int", "pos_z_int")):
+            value = obj[key]
+            if value is not None:
+                result[row, col] = value / 1024
+    return result
+
+class HQMWorldModel:
+    # Positions and derived data for one HQMGameState. Get it through
+    # gamestate.world, which creates it once per snapshot.
+    # Velocities are in meters per simulation step.
+    def __init__(self, gamestate):
+        self.gamestate = gamestate
+        objects = gamestate.objects
+        self.indices = np.array(sorted(objects), dtype=np.int64)
+        self.rows = {i: row for row, i in enumerate(self.indices.tolist())}
+        self.positions = object_positions(objects, self.indices.tolist())
+        
+        self.puck_indices = np.array([i for i in self.indices.tolist() if objects[i]["type"] == "PUCK"], dtype=np.int64)
+        self.puck_positions = self.positions[[self.rows[i] for i in self.puck_indices.tolist()]]
+        
+        # Object index to player, and object indices of each team
+        self.object_players = {}
+        team_indices = {0: [], 1: []}
+        for i in gamestate.object_players:
+            player = gamestate.object_player(i)
+            if player is None or i not in self.rows:
+                continue
+            self.object_players[i] = player
+            if player["team"] in team_indices:
+                team_indices[player["team"]].append(i)
+        self.team_indices = {}
+        self.team_positions = {}
+        for team, indices in team_indices.items():
+            indices.sort()
+            self.team_indices[team] = np.array(indices, dtype=np.int64)
+            self.team_positions[team] = self.positions[[self.rows[i] for i in indices]].reshape(-1, 3)
+            
+        self._distances = None
+        self._velocities = None
+        
+    @property
+    def distances(self):
+        # Pairwise distance between all objects, rows and columns in the order of self.indices
+        if self._distances is None:
+            diff = self.positions[:, np.newaxis, :] - self.positions[np.newaxis, :, :]
+            self._distances = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+        return self._distances
+        
+    @property
+    def velocities(self):
+        # Velocity of all objects compared to the previous snapshot, NaN if unknown
+        if self._velocities is None:
+            gamestate = self.gamestate
+            previous = gamestate.previous_objects
+            steps = gamestate.simstep - gamestate.previous_simstep if previous is not None else 0
+            if steps <= 0:
+                self._velocities = np.full_like(self.positions, np.nan)
+            else:
+                old_positions = object_positions(previous, self.indices.tolist())
+                self._velocities = (self.positions - old_positions) / steps
+        return self._velocities
+        
+    def position(self, i):
+        return self.positions[self.rows[i]]
+        
+    def velocity(self, i):
+        return self.velocities[self.rows[i]]
+        
+    def distance(self, i, j):
+        return self.distances[self.rows[i], self.rows[j]]
+        
+    def player_object(self, player_index):
+        # Object index of a player, or None for spectators
+        player = self.gamestate.players.get(player_index)
+        if player is None or player["obj"] not in self.rows:
+            return None
+        return player["obj"]
+        
+    def nearest_puck(self, point):
+        # Returns (object index, distance) of the puck nearest to point, or (None, inf)
+        if len(self.puck_indices) == 0:
+            return None, np.inf
+        diff = self.puck_positions - np.asarray(point, dtype=np.float32)
+        dist = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+        if np.all(np.isnan(dist)):
+            return None, np.inf
+        row = np.nanargmin(dist)
+        return int(self.puck_indices[row]), float(dist[row])
+        
+    def nearest(self, point, team):
+        # Returns (object index, distance) of the player of team nearest to point, or (None, inf)
+        positions = self.team_positions[team]
+        if len(positions) == 0:
+            return None, np.inf
+        diff = positions - np.asarray(point, dtype=np.float32)
+        dist = np.sqrt(np.einsum("ij,ij->i", diff, diff))
+        if np.all(np.isnan(dist)):
+            return None, np.inf
+        row = np.nanargmin(dist)
+        return int(self.team_indices[team][row]), float(dist[row])
@@ -0,0 +1,134 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from hqmstats import Histogram
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+decode_quantiles = (0.5, 0.9, 0.99)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append('{}="{}"'.format(key, value))
+    return "{" + ",".join(escaped) + "}"
+
+def format_metric(lines, name, type, help, samples):
+    # samples is a list of (labels, value)
+    lines.append("# HELP {} {}".format(name, help))
+    lines.append("# TYPE {} {}".format(name, type))
+    for labels, value in samples:
+        lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+class MetricsServer:
+    # Serves the text returned by render at /metrics over HTTP from a daemon
+    # thread, in the Prometheus text format
+    def __init__(self, render, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class MonitorMetrics:
+    # Health of a monitored server. The receive loop only updates counters;
+    # the text is put together when the endpoint is scraped.
+    def __init__(self, server, sink=None):
+        self.labels = {"server": server}
+        self.sink = sink
+        self.packets = 0
+        self.bytes = 0
+        self.decode_time = Histogram(1000000)
+        self.events = {}
+        self.rate_time = time.monotonic()
+        self.rate_packets = 0
+        self.packet_rate = 0.0
+        self.gamestate = None
+        self.synced = False
+
+    def on_packet(self, size, decode_time, session):
+        self.packets += 1
+        self.bytes += size
+        self.decode_time.add(decode_time)
+        if session.gamestate is not None:
+            self.gamestate = session.gamestate
+            self.synced = session.last_message_num == 0
+        now = time.monotonic()
+        if now - self.rate_time >= 1:
+            self.packet_rate = (self.packets - self.rate_packets) / (now - self.rate_time)
+            self.rate_time = now
+            self.rate_packets = self.packets
+
+    def on_event(self, msg):
+        self.events[msg["type"]] = self.events.get(msg["type"], 0) + 1
+
+    def render(self):
+        labels = self.labels
+        lines = []
+        packet_rate = self.packet_rate
+        elapsed = time.monotonic() - self.rate_time
+        if elapsed >= 2:
+            # Nothing has arrived for a while
+            packet_rate = (self.packets - self.rate_packets) / elapsed
+        format_metric(lines, "hqm_packets_total", "counter", "Datagrams received from the server",
+                      [(labels, self.packets)])
+        format_metric(lines, "hqm_received_bytes_total", "counter", "Bytes received from the server",
+                      [(labels, self.bytes)])
+        format_metric(lines, "hqm_packets_per_second", "gauge", "Datagrams received per second",
+                      [(labels, "{:.3f}".format(packet_rate))])
+        decode_time = self.decode_time
+        lines.append("# HELP hqm_decode_seconds Time spent decoding a datagram")
+        lines.append("# TYPE hqm_decode_seconds summary")
+        for quantile in decode_quantiles:
+            value = decode_time.percentile(quantile*100)
+            lines.append("hqm_decode_seconds{} {}".format(format_labels(dict(labels, quantile=quantile)),
+                                                          "NaN" if value is None else value))
+        lines.append("hqm_decode_seconds_sum{} {}".format(format_labels(labels), decode_time.total))
+        lines.append("hqm_decode_seconds_count{} {}".format(format_labels(labels), decode_time.count))
+        format_metric(lines, "hqm_events_total", "counter", "Game events received, by type",
+                      [(dict(labels, type=type), count) for type, count in sorted(self.events.items())])
+        format_metric(lines, "hqm_synced", "gauge", "1 if all old events have been received",
+                      [(labels, int(self.synced))])
+        gamestate = self.gamestate
+        if gamestate is not None:
+            format_metric(lines, "hqm_players", "gauge", "Players on the server",
+                          [(labels, len(gamestate.players))])
+            format_metric(lines, "hqm_score", "gauge", "Goals of each team in the current game",
+                          [(dict(labels, team="red"), gamestate.redscore),
+                           (dict(labels, team="blue"), gamestate.bluescore)])
+            format_metric(lines, "hqm_period", "gauge", "Current period, 0 is warmup",
+                          [(labels, gamestate.period)])
+            format_metric(lines, "hqm_simstep", "gauge", "Simulation step of the newest game update",
+                          [(labels, gamestate.simstep)])
+        if self.sink is not None:
+            format_metric(lines, "hqm_log_dropped_total", "counter", "Events dropped because the log could not keep up",
+                          [(labels, self.sink.dropped)])
+            format_metric(lines, "hqm_log_written_total", "counter", "Events written to the log",
+                          [(labels, self.sink.written)])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,108 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+import os
+import json
+import time
+
+default_path = os.path.join(os.path.expanduser("~"), ".hqmutils_cache.json")
+
+# Entries younger than ttl seconds are fresh and can be used without asking
+# the network. Older entries are stale: they can still be shown while a new
+# request is sent, until they are older than max_stale seconds.
+default_list_ttl = 60
+default_info_ttl = 5
+default_max_stale = 3600
+
+def list_key(master):
+    return "list {}:{}".format(master[0], master[1])
+
+def info_key(ip, port):
+    return "info {}:{}".format(ip, port)
+
+class HQMServerCache:
+    def __init__(self, path=default_path, list_ttl=default_list_ttl,
+                 info_ttl=default_info_ttl, max_stale=default_max_stale, save_interval=5):
+        self.path = path
+        self.list_ttl = list_ttl
+        self.info_ttl = info_ttl
+        self.max_stale = max_stale
+        self.save_interval = save_interval
+        self.entries = {}
+        self.dirty = False
+        self.last_save = 0
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        if isinstance(entries, dict):
+            self.entries.update(entries)
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        # Merge with what other processes have written since we loaded,
+        # keeping whichever entry is newest
+        try:
+            with open(self.path, "r") as f:
+                on_disk = json.load(f)
+        except (OSError, ValueError):
+            on_disk = {}
+        if isinstance(on_disk, dict):
+            for key, entry in on_disk.items():
+                own = self.entries.get(key)
+                if own is None or own["time"] < entry["time"]:
+                    self.entries[key] = entry
+        now = time.time()
+        self.entries = {key: entry for key, entry in self.entries.items()
+                        if now - entry["time"] < self.max_stale}
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            return
+        self.dirty = False
+        self.last_save = now
+
+    def maybe_save(self):
+        if self.dirty and time.time() - self.last_save >= self.save_interval:
+            self.save()
+
+    def get(self, key, ttl):
+        # Returns (value, fresh). value is None if there is no usable entry.
+        entry = self.entries.get(key)
+        if entry is None:
+            return None, False
+        age = time.time() - entry["time"]
+        if age >= self.max_stale:
+            return None, False
+        return entry["value"], age < ttl
+
+    def put(self, key, value):
+        self.entries[key] = {"time": time.time(), "value": value}
+        self.dirty = True
+
+    def get_server_list(self, master):
+        addresses, fresh = self.get(list_key(master), self.list_ttl)
+        if addresses is not None:
+            addresses = [(ip, port) for ip, port in addresses]
+        return addresses, fresh
+
+    def put_server_list(self, master, addresses):
+        self.put(list_key(master), [[ip, port] for ip, port in addresses])
+
+    def get_info(self, ip, port):
+        return self.get(info_key(ip, port), self.info_ttl)
+
+    def put_info(self, ip, port, info):
+        # info is a dict with the keys ping, players, teamsize, version and name
+        self.put(info_key(ip, port), info)
@@ -0,0 +1,217 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+# Publishes the newest game state of a session in shared memory, so that
+# any number of local processes can follow a server through one connection.
+#
+# The region has a fixed layout, described by region_dtype. It is guarded by
+# a sequence lock: the writer makes seq odd, writes, and makes it even again.
+# A reader copies the region and keeps the copy only if seq was even and the
+# same before and after.
+
+import time
+import numpy as np
+from multiprocessing import shared_memory
+import hqm
+
+magic = b"HQMS"
+layout_version = 1
+max_objects = 32
+max_players = 64
+unknown = -1 # Integer values the session doesn't know
+
+header_dtype = np.dtype([
+    ("magic", "S4"), ("version", "<u4"), ("seq", "<u8"),
+    ("published", "<f8"), # time.time() of the last publication
+    ("game_id", "<i8"), ("simstep", "<i8"), ("packet", "<i8"), ("msg_pos", "<i4"),
+    ("you", "<i4"), ("redscore", "<i4"), ("bluescore", "<i4"), ("period", "<i4"),
+    ("time", "<i4"), ("timeout", "<i4"), ("gameover", "<i4")
+])
+# Object values are the integers sent by the server, see HQMObjectState
+object_dtype = np.dtype([
+    ("type", "<i4"), # -1 if there is no object, 0 for players, 1 for pucks, or the type number sent
+    ("pos", "<i4", (3,)), ("rot", "<i4", (2,)),
+    ("stick_pos", "<i4", (3,)), ("stick_rot", "<i4", (2,)),
+    ("head_rot", "<i4"), ("body_rot", "<i4")
+])
+player_dtype = np.dtype([
+    ("present", "u1"), ("team", "i1"), ("obj", "i1"), ("goal", "<u2"), ("assist", "<u2"),
+    ("name", "S32")
+])
+region_dtype = np.dtype([
+    ("header", header_dtype),
+    ("objects", object_dtype, (max_objects,)),
+    ("players", player_dtype, (max_players,))
+])
+
+object_keys = (
+    ("pos", ("pos_x_int", "pos_y_int", "pos_z_int")),
+    ("rot", ("rot_a_int", "rot_b_int")),
+    ("stick_pos", ("stick_x_int", "stick_y_int", "stick_z_int")),
+    ("stick_rot", ("stick_rot_a_int", "stick_rot_b_int")),
+    ("head_rot", ("head_rot_int",)),
+    ("body_rot", ("body_rot_int",))
+)
+object_types = {"PLAYER": 0, "PUCK": 1}
+type_names = {0: "PLAYER", 1: "PUCK"}
+player_fields = ("stick_pos", "stick_rot", "head_rot", "body_rot")
+
+def default_name(ip, port):
+    return "hqm_{}_{}".format(ip.replace(".", "_").replace(":", "_"), port)
+
+def attach(name):
+    # Opens an existing region without letting this process remove it on exit
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError: # Before Python 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class HQMStatePublisher:
+    def __init__(self, name):
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name, create=True, size=region_dtype.itemsize)
+        self.region = np.ndarray((), dtype=region_dtype, buffer=self.shm.buf)
+        self.region[()] = np.zeros((), dtype=region_dtype)
+        header = self.region["header"]
+        header["magic"] = magic
+        header["version"] = layout_version
+        # Filled in first, so that the lock is held only while copying
+        self.header = np.zeros((), dtype=header_dtype)
+        self.objects = np.zeros(max_objects, dtype=object_dtype)
+        self.players = np.zeros(max_players, dtype=player_dtype)
+        self.last = None
+
+    def publish(self, gamestate):
+        # Returns False if gamestate is the one already published
+        key = (gamestate.id, gamestate.packet, gamestate.msg_pos)
+        if key == self.last:
+            return False
+        self.last = key
+        header = self.header
+        header["magic"] = magic
+        header["version"] = layout_version
+        header["published"] = time.time()
+        header["game_id"] = gamestate.id
+        header["simstep"] = gamestate.simstep
+        header["packet"] = gamestate.packet
+        header["msg_pos"] = gamestate.msg_pos
+        header["you"] = unknown if gamestate.you is None else gamestate.you
+        for field in ("redscore", "bluescore", "period", "time", "timeout", "gameover"):
+            header[field] = getattr(gamestate, field)
+
+        objects = self.objects
+        objects["type"] = unknown
+        for i, obj in gamestate.objects.items():
+            type = object_types.get(obj["type"], obj["type"])
+            if not isinstance(type, int):
+                raise ValueError("Unknown object type {!r}".format(obj["type"]))
+            objects["type"][i] = type
+            for field, keys in object_keys:
+                values = [unknown if obj.get(key) is None else obj[key] for key in keys]
+                objects[field][i] = values if len(values) > 1 else values[0]
+
+        players = self.players
+        players["present"] = 0
+        for i, player in gamestate.players.items():
+            players[i] = (1, player["team"], player["obj"], player["goal"], player["assist"],
+                          player["name"].encode("ascii", "ignore")[:32])
+
+        seq = int(self.region["header"]["seq"])
+        self.region["header"]["seq"] = seq + 1 # Odd: being written
+        header["seq"] = seq + 1
+        self.region["objects"] = objects
+        self.region["players"] = players
+        self.region["header"] = header
+        self.region["header"]["seq"] = seq + 2
+        return True
+
+    def close(self):
+        self.region = None
+        self.shm.close()
+        self.shm.unlink()
+
+class HQMStateReader:
+    # view is the region itself, which can be read without copying between
+    # begin() and a successful valid(). read() returns a checked copy.
+    def __init__(self, name):
+        self.name = name
+        self.shm = attach(name)
+        self.view = np.ndarray((), dtype=region_dtype, buffer=self.shm.buf)
+        header = self.view["header"]
+        if bytes(header["magic"]) != magic or int(header["version"]) != layout_version:
+            self.close()
+            raise ValueError("{} is not an HQM state region".format(name))
+
+    def begin(self):
+        # Waits until no write is in progress and returns the sequence number
+        while True:
+            seq = int(self.view["header"]["seq"])
+            if seq % 2 == 0:
+                return seq
+            time.sleep(0)
+
+    def valid(self, seq):
+        # True if nothing was written since begin() returned seq
+        return int(self.view["header"]["seq"]) == seq
+
+    def read(self, retries=100):
+        # A consistent copy of the region, or None if nothing has been
+        # published yet or the writer never stopped writing
+        for attempt in range(retries):
+            seq = self.begin()
+            if seq == 0:
+                return None
+            copy = self.view.copy()
+            if self.valid(seq):
+                return copy
+        return None
+
+    def read_gamestate(self):
+        # The published state as an HQMGameState, or None. Objects have the
+        # same integer keys the session gives them, so calculate_positions works.
+        region = self.read()
+        if region is None:
+            return None
+        return to_gamestate(region)
+
+    def close(self):
+        self.view = None
+        self.shm.close()
+
+def to_gamestate(region):
+    header = region["header"]
+    gamestate = hqm.HQMGameState(int(header["game_id"]))
+    for field in ("simstep", "packet", "msg_pos", "redscore", "bluescore", "period",
+                  "time", "timeout", "gameover"):
+        setattr(gamestate, field, int(header[field]))
+    you = int(header["you"])
+    gamestate.you = None if you == unknown else you
+    objects = region["objects"]
+    columns = {field: objects[field].tolist() for field, keys in object_keys}
+    for i, type in enumerate(objects["type"].tolist()):
+        if type == unknown:
+            continue
+        obj = hqm.HQMObjectState()
+        obj["type"] = type_names.get(type, type)
+        for field, keys in object_keys:
+            if field in player_fields and obj["type"] != "PLAYER":
+                continue
+            values = columns[field][i]
+            if not isinstance(values, list):
+                values = (values,)
+            for key, value in zip(keys, values):
+                obj[key] = None if value == unknown else value
+        obj["i"] = i
+        gamestate.objects[i] = obj
+    for i, (present, team, obj, goal, assist, name) in enumerate(region["players"].tolist()):
+        if not present:
+            continue
+        gamestate.players[i] = {"team": team, "name": name.decode("ascii", "ignore"), "obj": obj,
+                                "index": i, "goal": goal, "assist": assist}
+        if obj != unknown:
+            gamestate.object_players[obj] = i
+    return gamestate
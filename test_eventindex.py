@@ -0,0 +1,106 @@
+# Copyright © 2017, John Eriksson
+# https://github.com/migomipo/hqmutils
+# See LICENSE for terms of use
+
+# Run with python -m unittest test_eventindex
+
+import os
+import shutil
+import tempfile
+import unittest
+import hqm
+import capture
+import eventindex
+from bitparse import CSBitWriter
+
+game_id = 1234
+
+def new_match():
+    bw = CSBitWriter()
+    bw.write_bytes_aligned(hqm.header)
+    bw.write_unsigned(8, hqm.SCMD_NEW_MATCH)
+    bw.write_unsigned_aligned(32, game_id)
+    return bw.get_bytes()
+
+def write_event(bw, event):
+    if event[0] == "JOIN":
+        type, player, team, obj, name = event
+        bw.write_unsigned(6, 0)
+        bw.write_unsigned(6, player)
+        bw.write_unsigned(1, 1)
+        bw.write_unsigned(2, team)
+        bw.write_unsigned(6, obj)
+        for c in name.encode("ascii").ljust(31, b"\0"):
+            bw.write_unsigned(7, c)
+    else:
+        type, player, message = event
+        bw.write_unsigned(6, 2)
+        bw.write_unsigned(6, player)
+        message = message.encode("ascii")
+        bw.write_unsigned(6, len(message))
+        for c in message:
+            bw.write_unsigned(7, c)
+
+def game_update(packet, simstep, events, msg_pos):
+    # A game update without objects
+    bw = CSBitWriter()
+    bw.write_bytes_aligned(hqm.header)
+    bw.write_unsigned(8, hqm.SCMD_GAME_UPDATE)
+    bw.write_unsigned_aligned(32, game_id)
+    bw.write_unsigned_aligned(32, simstep)
+    bw.write_unsigned(1, 0)
+    bw.write_unsigned(8, 0)
+    bw.write_unsigned(8, 0)
+    bw.write_unsigned(16, 30000)
+    bw.write_unsigned(16, 0)
+    bw.write_unsigned(8, 1)
+    bw.write_unsigned(8, 0)
+    bw.write_unsigned_aligned(32, packet)
+    bw.write_unsigned_aligned(32, 0xffffffff)
+    for i in range(32):
+        bw.write_unsigned(1, 0)
+    bw.write_unsigned(4, len(events))
+    bw.write_unsigned(16, msg_pos)
+    for event in events:
+        write_event(bw, event)
+    return bw.get_bytes()
+
+class TruncatedCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.capture_path = os.path.join(self.dir, "match.hqm")
+        first = [("JOIN", 0, 0, 0, "Migo"), ("CHAT", 0, "hello"), ("CHAT", 5, "who am I")]
+        second = [("CHAT", 0, "still here")]
+        writer = capture.CaptureWriter(self.capture_path, "127.0.0.1:27585")
+        writer.write(new_match(), 1.0)
+        writer.write(game_update(1, 10, first, 0), 1.1)
+        writer.write(game_update(2, 20, second, 3)[:20], 1.2) # Cut short
+        writer.write(game_update(3, 30, second, 3), 1.3)
+        writer.write(game_update(4, 40, [], 4)[:20], 1.4)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay_raises_without_on_error(self):
+        with self.assertRaises(IndexError):
+            list(capture.replay(self.capture_path))
+
+    def test_ingest_skips_corrupt_datagrams(self):
+        index = eventindex.HQMEventIndex(os.path.join(self.dir, "events.db"))
+        try:
+            errors = []
+            added = index.ingest(self.capture_path, lambda arrival, ex: errors.append(arrival))
+            self.assertEqual(added, 4)
+            self.assertEqual(errors, [1.2, 1.4])
+            messages = [event["message"] for event in index.find(type="CHAT")]
+            self.assertEqual(messages, ["hello", "who am I", "still here"])
+            unknown = index.find(text="who am I")[0]
+            self.assertIsNone(unknown["name"])
+            # The same datagrams are skipped again, so nothing is added twice
+            self.assertEqual(index.ingest(self.capture_path), 0)
+        finally:
+            index.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,8 +2,11 @@
 # https://github.com/migomipo/hqmutils
 # See LICENSE for terms of use
 
+# Modules that only some commands need, such as eventsink, are imported by
+# those commands. selectors is imported by socket anyway.
 import sys
 import socket
+import selectors
 import hqm
 import time
 
@@ -11,97 +14,129 @@ master_addr = "216.55.185.95"
 master_port = 27590
 master = (master_addr, master_port)
 
+info_format = "{:<17}{:<8}{:<8}{:<8}{:<8}{:<8}{}"
+revalidate_timeout = 1.0 # Seconds to wait for replies that only refresh the cache
+
 def print_help(args=None):
     print("MigoMipo HQM Utils © John Eriksson 2017")
     print("Commands:")
     print("  gui                  : Nice graphical interface")
     print("  info <ip> <port>     : Shows info about a specific server")
     print("  info public          : Shows info about all public servers")
+    print("  info ... -r          : Ignores cached server lists and info")
     print("  state <ip> <port>    : Joins a server, prints information and leaves")
     print("  state <ip> <port> -l : Also prints a log of all received events")
+    print("  state <ip> <port> -f : Syncs as fast as possible and prints the time it took")
     print("  monitor <ip> <port>  : Joins a server and log all events until interrupted")
+    print("  monitor ... -j       : Logs events as JSON lines")
+    print("  monitor ... -c       : Logs events as CSV")
+    print("  monitor ... -o <file>: Appends the log to a file instead of printing it")
+    print("  monitor ... -s <size>: Rotates the log file when it grows larger than size bytes")
+    print("  monitor ... -m <port>: Serves Prometheus metrics at http://127.0.0.1:<port>/metrics")
+    print("  monitor ... -w <n>   : Holds back up to n updates that arrive ahead of a missing one")
+    print("  record <ip> <port> <file>")
+    print("                       : Joins a server and records everything it sends to a capture file")
+    print("  index <db> <file>... : Adds the events of captures and JSON monitor logs to an SQLite database")
+    print("  events <db> [-t <type>] [-n <name>] [-g <scorer>] [-s <text>] [-l <limit>]")
+    print("                       : Searches the events in a database")
+    print("  publish <ip> <port> [name]")
+    print("                       : Joins a server and keeps its state in shared memory")
+    print("  netstat <ip> <port> [seconds]")
+    print("                       : Joins a server and measures the connection quality")
+    
+def get_option(args, name, default=None):
+    if name in args:
+        i = args.index(name)
+        if i+1 < len(args):
+            return args[i+1]
+    return default
     
 def get_millis_truncated():
     return int(round(time.time() * 1000)) & 0xffffffff
-  
-
-def int_to_team(n):  
-    if n == -1:
-        team = "-"
-    elif n == 0:
-        team = "RED"
-    elif n == 1:
-        team = "BLUE"
-    return team
-    
     
-def get_log_line(msg, format, player_list):
-    type = msg["type"]
-    if type=="JOIN":
-        i = msg["player"]
-        name = msg["name"]
-        team = int_to_team(msg["team"])
-        message = ""
-    elif type=="EXIT":
-        i = msg["player"]
-        name = msg["name"]
-        team = ""
-        message = ""
-    elif type=="GOAL":
-        i = ""        
-        name = ""
-        team = int_to_team(msg["team"])
-        scoring = player_list.get(msg["scoring_player"])
-        assisting = player_list.get(msg["assisting_player"])
-        if assisting:
-            message = "{}(#{}), assisted by {}(#{})".format(
-                scoring["name"], scoring["index"], assisting ["name"], assisting ["index"])
-        elif scoring:
-            message = "{}(#{}) ".format(
-                scoring["name"], scoring["index"])
-        else:
-            message = ""
-    elif type=="CHAT":
-        i = msg["player"]
-        if i==-1:
-            i = ""
-            name = ""
-            team = ""
-        else:
-            chatter = player_list.get(i)
-            name = chatter["name"]
-            team = int_to_team(chatter["team"])
-        message = msg["message"]
-    return format.format(type, i, name, team, message) 
-
+def run_session(sock, session, addr, handler, interval=0.05, max_batch=64, ack_on_receive=False, until=None,
+                on_flush=None):
+    # Sends a session update every interval seconds and calls handler for
+    # every received datagram as soon as it arrives, until handler returns True
+    # or, if until is given, the monotonic clock reaches until.
+    # At most max_batch datagrams are read per wakeup so sending never starves.
+    # With ack_on_receive, an update is also sent right after each batch,
+    # so the server learns about received messages without waiting for the tick.
+    # Updates held back by the session's reorder buffer are applied when it
+    # stops waiting for them, and then on_flush is called if given.
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, selectors.EVENT_READ)
+        next_send = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if until is not None and now >= until:
+                return
+            if now >= next_send:
+                sock.sendto(session.get_message(), addr)
+                next_send += interval
+                if next_send < now:
+                    next_send = now + interval # We fell behind, don't burst
+            timeout = max(0, next_send - time.monotonic())
+            if until is not None:
+                timeout = min(timeout, max(0, until - time.monotonic()))
+            deadline = session.reorder_deadline()
+            if deadline is not None:
+                timeout = min(timeout, max(0, deadline - time.monotonic()))
+            if not selector.select(timeout):
+                if deadline is not None and time.monotonic() >= deadline:
+                    gamestate = session.gamestate
+                    session.flush_reorder_buffer()
+                    if on_flush is not None and session.gamestate is not gamestate:
+                        if on_flush():
+                            return
+                continue
+            received = False
+            for i in range(max_batch):
+                try:
+                    data = sock.recv(8192)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    break # ICMP errors such as port unreachable
+                if handler(data):
+                    return
+                received = True
+            if received and ack_on_receive:
+                sock.sendto(session.get_message(), addr)
+                next_send = time.monotonic() + interval
+  
 
-           
 def state(args):
     if len(args)<2:
         print("Usage: state <ip> <port>");
         return  
+    import eventsink
     ip = args[0]
     port = int(args[1])
     addr = (ip, port)
 
     show_log = "-l" in args
-    gamestate = None
+    fast = "-f" in args
+    packets = 0
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
         sock.setblocking(False)
         session = hqm.HQMClientSession("MigoMibot",55)
-        while True:
-            send = session.get_message()
-            sock.sendto(session.get_message(), addr)
-            while True:
-                try:
-                    data = sock.recv(8192)
-                    gamestate = session.parse_message(data)
-                except:
-                    break
-            if session.last_message_num==0:
-                break
-            time.sleep(0.05) 
-        sock.sendto(session.get_exit_message(), addr)
+        # Chat text is only needed for the log
+        session.decode_chat = show_log
+        
+        def handle(data):
+            nonlocal packets
+            packets += 1
+            session.parse_message(data)
+            return session.last_message_num==0
+            
+        start = time.monotonic()
+        try:
+            run_session(sock, session, addr, handle, ack_on_receive=fast)
+        finally:
+            sock.sendto(session.get_exit_message(), addr)
+        sync_time = time.monotonic() - start
+    gamestate = session.gamestate
               
     print("Score:   {} - {}".format(gamestate.redscore, gamestate.bluescore))  
     time_left = gamestate.time
@@ -116,11 +151,13 @@ def state(args):
     if period == 0:
         period = "Warmup"
     print("Period:  {}".format(period))  
+    if fast:
+        print("Synced:  {} ms, {} packets".format(int(sync_time*1000), packets))
     print("Players:")
     format = "{:<4}{:<30}{:<8}{:<5}{:<5}"
     print(format.format("#", "NAME", "TEAM", "G", "A"))
     for player in gamestate.players.values():
-        team = int_to_team(player["team"])
+        team = eventsink.int_to_team(player["team"])
         index = str(player["index"])
         if player["index"] == gamestate.you:
             index += "*"
@@ -133,62 +170,277 @@ def state(args):
         print(format.format("TYPE", "#", "NAME", "TEAM", "MESSAGE"))  
         for msg in events:
             hqm.update_player_list(player_list, msg)           
-            print(get_log_line(msg, format, player_list))                
+            print(eventsink.get_log_line(msg, format, player_list))                
                 
 def monitor(args):
     if len(args)<2:
-        print("Usage: monitor <ip> <port>");
+        print("Usage: monitor <ip> <port> [-j|-c] [-o <file>] [-s <size>] [-m <port>] [-w <n>]");
         return  
     ip = args[0]
     port = int(args[1])
     addr = (ip, port)
+    server = "{}:{}".format(ip, port)
+    
+    import eventsink
+    if "-j" in args:
+        encoder = eventsink.JSONLinesEncoder()
+    elif "-c" in args:
+        encoder = eventsink.CSVEncoder()
+    else:
+        encoder = eventsink.TextEncoder()
+    try:
+        rotate_bytes = int(get_option(args, "-s", 0))
+        reorder_window = int(get_option(args, "-w", 0))
+        metrics_port = get_option(args, "-m")
+        if metrics_port is not None:
+            metrics_port = int(metrics_port)
+    except ValueError:
+        print("Incorrect arguments")
+        return
+    sink = eventsink.EventSink(encoder, path=get_option(args, "-o"), rotate_bytes=rotate_bytes)
+    
+    metrics = None
+    metrics_server = None
+    if metrics_port is not None:
+        import metrics as metrics_module
+        metrics = metrics_module.MonitorMetrics(server, sink)
+        try:
+            metrics_server = metrics_module.MetricsServer(metrics.render, metrics_port).start()
+        except OSError as ex:
+            print("Could not serve metrics: {}".format(ex), file=sys.stderr)
+            return
     
-    gamestate = None
     last_msg_pos = 0
-    format = "{:<6}{:<4}{:<32}{:<6}{}"
     player_list = {}
-    print(format.format("TYPE", "#", "NAME", "TEAM", "MESSAGE"))  
+    sink.start()
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
         sock.setblocking(False)
         session = hqm.HQMClientSession("MigoMibot",55)
+        session.reorder_window = reorder_window
+        
+        def handle(data):
+            if metrics is not None:
+                start = time.perf_counter()
+                gamestate = session.parse_message(data)
+                metrics.on_packet(len(data), time.perf_counter() - start, session)
+            else:
+                gamestate = session.parse_message(data)
+            log_events(gamestate)
+            
+        def log_events(gamestate):
+            nonlocal last_msg_pos
+            if gamestate and gamestate.msg_pos>last_msg_pos:
+                events = gamestate.events[last_msg_pos:gamestate.msg_pos]
+                last_msg_pos = gamestate.msg_pos
+                now = time.time()
+                for msg in events:
+                    hqm.update_player_list(player_list, msg)
+                    record = eventsink.get_log_record(msg, player_list)
+                    record["time"] = now
+                    record["server"] = server
+                    record["game"] = gamestate.id
+                    record["simstep"] = gamestate.simstep
+                    sink.put(record)
+                    if metrics is not None:
+                        metrics.on_event(msg)
+                    
         try:
-            while True:
-                send = session.get_message()
-                sock.sendto(session.get_message(), addr)
-                while True:
-                    try:
-                        data = sock.recv(8192)
-                        gamestate = session.parse_message(data)
-                        if(gamestate.msg_pos>last_msg_pos):
-                            events = gamestate.events[last_msg_pos:gamestate.msg_pos]
-                            last_msg_pos = gamestate.msg_pos
-                            for msg in events:
-                                hqm.update_player_list(player_list, msg)
-                                print(get_log_line(msg, format, player_list)) 
-                    except OSError:
-                        break
-
-                time.sleep(0.05) 
+            run_session(sock, session, addr, handle, on_flush=lambda: log_events(session.gamestate))
         except KeyboardInterrupt:
             pass
         sock.sendto(session.get_exit_message(), addr)
+    if metrics_server is not None:
+        metrics_server.close()
+    sink.close()
+    if sink.error is not None:
+        print("Could not write log: {}".format(sink.error), file=sys.stderr)
+    if sink.dropped > 0:
+        print("{} events were dropped because output could not keep up".format(sink.dropped), file=sys.stderr)
 
   
 
+def record(args):
+    if len(args)<3:
+        print("Usage: record <ip> <port> <file>");
+        return  
+    ip = args[0]
+    port = int(args[1])
+    addr = (ip, port)
+    
+    import capture
+    writer = capture.CaptureWriter(args[2], "{}:{}".format(ip, port))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        session = hqm.HQMClientSession("MigoMibot",55)
+        
+        def handle(data):
+            writer.write(data)
+            session.parse_message(data)
+                
+        try:
+            run_session(sock, session, addr, handle)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.sendto(session.get_exit_message(), addr)
+            writer.close()
+    print("Recorded {} datagrams".format(writer.count))
+    
+def index(args):
+    if len(args)<2:
+        print("Usage: index <db> <file>...");
+        return
+    import eventindex
+    event_index = eventindex.HQMEventIndex(args[0])
+    try:
+        for path in args[1:]:
+            errors = []
+            try:
+                added = event_index.ingest(path, lambda arrival, ex: errors.append(ex))
+            except Exception as ex:
+                # One bad file doesn't stop the others. Batches that were
+                # committed are kept and the file continues from there next time.
+                print("{}: {}: {}".format(path, type(ex).__name__, ex), file=sys.stderr)
+                continue
+            if errors:
+                print("{}: skipped {} datagrams that could not be decoded ({}: {})".format(
+                    path, len(errors), type(errors[0]).__name__, errors[0]), file=sys.stderr)
+            print("{}: {} new events".format(path, added))
+    except KeyboardInterrupt:
+        pass # Everything up to the last batch is kept
+    finally:
+        event_index.close()
+        
+def events(args):
+    if len(args)<1:
+        print("Usage: events <db> [-t <type>] [-n <name>] [-g <scorer>] [-s <text>] [-l <limit>]");
+        return
+    import eventindex
+    try:
+        limit = get_option(args, "-l")
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        print("Incorrect arguments")
+        return
+    event_index = eventindex.HQMEventIndex(args[0])
+    try:
+        found = event_index.find(type=get_option(args, "-t"), name=get_option(args, "-n"),
+                                 scorer=get_option(args, "-g"), text=get_option(args, "-s"), limit=limit)
+    finally:
+        event_index.close()
+    format = "{:<20}{:<22}{:<6}{:<32}{}"
+    print(format.format("TIME", "SERVER", "TYPE", "NAME", "MESSAGE"))
+    for event in found:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["time"])) if event["time"] else ""
+        name = event["name"] or event["scoring_name"] or ""
+        message = event["message"] or ""
+        print(format.format(when, event["server"] or "", event["type"], name, message))
+
+def publish(args):
+    if len(args)<2:
+        print("Usage: publish <ip> <port> [name]");
+        return  
+    ip = args[0]
+    port = int(args[1])
+    addr = (ip, port)
+    
+    import shmstate
+    name = args[2] if len(args)>2 else shmstate.default_name(ip, port)
+    try:
+        publisher = shmstate.HQMStatePublisher(name)
+    except FileExistsError:
+        print("Shared memory {} is already in use".format(name), file=sys.stderr)
+        return
+    print("Publishing to shared memory {}".format(name))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        session = hqm.HQMClientSession("MigoMibot",55)
+        
+        def handle(data):
+            gamestate = session.parse_message(data)
+            if gamestate:
+                publisher.publish(gamestate)
+                
+        try:
+            run_session(sock, session, addr, handle)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.sendto(session.get_exit_message(), addr)
+            publisher.close()
+
+def netstat(args):
+    if len(args)<2:
+        print("Usage: netstat <ip> <port> [seconds]");
+        return  
+    ip = args[0]
+    port = int(args[1])
+    addr = (ip, port)
+    duration = float(args[2]) if len(args)>2 else 10
+    
+    import hqmnet
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        session = hqm.HQMClientSession("MigoMibot",55)
+        session.decode_chat = False
+        session.network = hqmnet.HQMNetworkStats()
+        
+        def handle(data):
+            session.parse_message(data)
+            
+        try:
+            run_session(sock, session, addr, handle, interval=0.01, until=time.monotonic()+duration)
+        finally:
+            sock.sendto(session.get_exit_message(), addr)
+    stats = session.network.snapshot()
+    if stats["received"] == 0:
+        print("No game updates received")
+        return
+        
+    def millis(seconds):
+        return "-" if seconds is None else "{:.1f} ms".format(seconds*1000)
+    def rate(value):
+        return "-" if value is None else "{:.1f}/s".format(value)
+    print("Updates:    {} received, {} expected".format(stats["received"], stats["expected"]))
+    print("Loss:       {} ({:.2%})".format(stats["lost"], stats["loss"]))
+    print("Reordered:  {} ({:.2%})".format(stats["reordered"], stats["reorder_rate"]))
+    print("Duplicates: {} ({:.2%})".format(stats["duplicates"], stats["duplicate_rate"]))
+    print("Jitter:     {}".format(millis(stats["jitter"])))
+    print("RTT:        {} (min {}, {} samples)".format(millis(stats["rtt"]), millis(stats["rtt_min"]), stats["rtt_samples"]))
+    print("Server:     {} simsteps, {} updates".format(rate(stats["tick_rate"]), rate(stats["update_rate"])))
+
 def server_info(args):
+    import servercache
+    cache = servercache.HQMServerCache()
+    refresh = "-r" in args
     if len(args)>0 and args[0] == "public":
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
             sock.settimeout(3)
-            sock.sendto(hqm.server_list_message, master)
-            data, addr = sock.recvfrom(1024)
-            addresses = hqm.parse_server_list(data)
+            addresses, fresh = (None, False) if refresh else cache.get_server_list(master)
+            if not fresh:
+                sock.sendto(hqm.server_list_message, master)
+            if addresses is None:
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except socket.timeout:
+                    print("Master server timed out")
+                    return
+                addresses = hqm.parse_server_list(data)
+                if addresses is None:
+                    print("Invalid reply from master server")
+                    return
+                cache.put_server_list(master, addresses)
+                fresh = True
+            # A stale list is used right away, the reply updates the cache
             if "-a" in args:
                 format = "{:<17}{:<8}"
                 print(format.format("ADDRESS", "PORT"))
                 for addr in addresses:
                     print(format.format(addr[0], addr[1]))  
+                receive_replies(sock, {}, cache, revalidate_list=not fresh)
             else:
-                get_server_info(sock, addresses)        
+                get_server_info(sock, addresses, cache, refresh, revalidate_list=not fresh)        
     elif len(args)>=2:
         ip = args[0]
         dests = []  
@@ -208,43 +460,77 @@ def server_info(args):
             return
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
             sock.settimeout(3)
-            get_server_info(sock, dests)        
+            get_server_info(sock, dests, cache, refresh)        
     else:
         print("Usage: info <ip> <port> or");
         print("       info public");
         print("You can request multiple ports at once by separating port numbers with , (no spaces)");
         print("You can request an entire port range by writing <port>-<port>");
+        print("Add -r to ignore cached results");
+        return
+    cache.save()
         
     
-def get_server_info(sock, addresses):
-
-    start_data = {}
-    for address in addresses:   
-        millis = get_millis_truncated()
-        start_data[address] = {"millis": millis}
-        message = hqm.make_info_request_cmessage(55, millis)
-        sock.sendto(message, address)
-    format = "{:<17}{:<8}{:<8}{:<8}{:<8}{:<8}{}"
-    print(format.format("ADDRESS", "PORT", "PING", "VERSION", "PLAYERS", "TEAM", "NAME"))
-    while len(start_data) > 0:
+def receive_replies(sock, pending, cache=None, revalidate_list=False):
+    # pending maps addresses to True if they were already shown from a stale
+    # cache entry. Replies to those, and to a stale server list request if
+    # revalidate_list, only refresh the cache, so they are waited for at most
+    # revalidate_timeout. Returns what is still pending.
+    timeout = sock.gettimeout()
+    start = time.monotonic()
+    while pending or revalidate_list:
+        if all(pending.values()):
+            remaining = revalidate_timeout - (time.monotonic() - start)
+        else:
+            remaining = timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        sock.settimeout(remaining)
         try:
             data, addr = sock.recvfrom(1024)
         except socket.timeout:
             break
-        if addr in start_data:
-            addr_data = start_data[addr]
+        if addr == master and revalidate_list:
+            addresses = hqm.parse_server_list(data)
+            if addresses is not None:
+                cache.put_server_list(master, addresses)
+                revalidate_list = False
+        elif addr in pending:
             msg = hqm.parse_from_server(data)
+            if msg is None or msg["type"] != hqm.SCMD_INFO_RESPONSE:
+                continue
             ping = get_millis_truncated()-msg["ping"]
-            players = msg["players"]
-            teamsize = msg["teamsize"]
-            version = msg["version"]
-            name = msg["name"]
             if ping < 0:
                 ping += 0xffffffff
-            print(format.format(addr[0], addr[1], ping, version, players, teamsize, name))    
-            
-            del start_data[addr]
-    for addr in start_data:
+            info = {"ping": ping, "players": msg["players"], "teamsize": msg["teamsize"],
+                    "version": msg["version"], "name": msg["name"]}
+            if cache:
+                cache.put_info(addr[0], addr[1], info)
+            if not pending[addr]:
+                print_server_info(addr, info)
+            del pending[addr]
+    sock.settimeout(timeout)
+    return pending
+
+def print_server_info(address, info):
+    print(info_format.format(address[0], address[1], info["ping"], info["version"],
+                             info["players"], info["teamsize"], info["name"]))
+
+def get_server_info(sock, addresses, cache=None, refresh=False, revalidate_list=False):
+    # Cached entries are shown right away. Stale ones are asked for again,
+    # and the reply is cached for the next time. A server that doesn't reply
+    # is reported as timed out, also after its stale row.
+    print(info_format.format("ADDRESS", "PORT", "PING", "VERSION", "PLAYERS", "TEAM", "NAME"))
+    pending = {}
+    for address in addresses:   
+        info, fresh = (None, False) if refresh or not cache else cache.get_info(address[0], address[1])
+        if info is not None:
+            print_server_info(address, info)
+            if fresh:
+                continue
+        pending[address] = info is not None
+        sock.sendto(hqm.make_info_request_cmessage(55, get_millis_truncated()), address)
+    for addr in receive_replies(sock, pending, cache, revalidate_list):
         print("{:<17}{:<8}TIMED OUT".format(addr[0], addr[1]))
         
 def gui(ignored):
@@ -256,6 +542,11 @@ commands = {
     "info": server_info,
     "state": state,
     "monitor": monitor,
+    "record": record,
+    "index": index,
+    "events": events,
+    "publish": publish,
+    "netstat": netstat,
     "gui": gui
 }
 
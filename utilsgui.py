@@ -2,7 +2,10 @@
 import sys
 import time
 import hqm
+import servercache
 import math
+import heapq
+import random
 import itertools
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -12,6 +15,7 @@ from PyQt5.QtNetwork import *
 
 master_addr = QHostAddress("66.226.72.227")
 master_port = 27590
+master = (master_addr.toString(), master_port)
 
 old_format = QTextCharFormat()
 player_format = QTextCharFormat()
@@ -20,6 +24,11 @@ server_format = QTextCharFormat(player_format)
 server_format.setForeground(QBrush(QColor("magenta")))
 goal_format = QTextCharFormat(player_format)
 goal_format.setForeground(QBrush(QColor("green")))
+team_formats = {}
+for team, color in ((-1, "grey"), (0, "red"), (1, "blue")):
+    team_formats[team] = QTextCharFormat(player_format)
+    team_formats[team].setForeground(QBrush(QColor(color)))
+team_names = {-1: "the spectators", 0: "the red team", 1: "the blue team"}
 
 def pairwise(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
@@ -30,6 +39,166 @@ def pairwise(iterable):
 def get_millis_truncated():
     return int(round(time.time() * 1000)) & 0xffffffff
     
+info_keys = ("ping", "players", "teamsize", "version", "name")
+
+# Server probing. Probes are spread out over time, servers that don't answer
+# or don't change are probed less often, and visible servers are probed first.
+probe_tick = 0.05           # How often the probe scheduler runs
+probe_interval = 1.0        # Normal time between probes of a server
+unchanged_probe_interval = 5.0
+unresponsive_probe_interval = 30.0
+probe_timeout = 1.0
+max_probes_in_flight = 256
+
+# Server windows redraw at most this many times per second
+default_fps = 30
+# Older lines are removed from the event log of a server window
+default_max_log_lines = 5000
+# Game updates a server window may hold back waiting for a missing one,
+# see HQMClientSession.reorder_window. 0 turns it off.
+default_reorder_window = 0
+    
+def start_worker(worker):
+    # Runs worker in a thread of its own. Its start slot is called from
+    # that thread, so everything it creates there belongs to the thread.
+    thread = QThread()
+    worker.moveToThread(thread)
+    thread.started.connect(worker.start)
+    thread.start()
+    return thread
+    
+class ServerProbeWorker(QObject):
+    # Owns the socket used for server list requests and info probes, and
+    # decodes the replies in its own thread. Replies that arrive together
+    # are posted together.
+    serverListReceived = pyqtSignal(object) # List of (ip, port)
+    infoReceived = pyqtSignal(object)       # List of (QHostAddress, port, info dict)
+    
+    def __init__(self):
+        QObject.__init__(self)
+        self.socket = None
+        
+    @pyqtSlot()
+    def start(self):
+        self.socket = QUdpSocket(self)
+        self.socket.bind(QHostAddress.Any)
+        self.socket.readyRead.connect(self._on_ready_read)
+        
+    @pyqtSlot(object)
+    def send_probes(self, addresses):
+        for address, port in addresses:
+            message = hqm.make_info_request_cmessage(55, get_millis_truncated())
+            self.socket.writeDatagram(message, address, port)
+            
+    @pyqtSlot()
+    def request_server_list(self):
+        self.socket.writeDatagram(hqm.server_list_message, master_addr, master_port)
+        
+    @pyqtSlot()
+    def stop(self):
+        self.socket.close()
+        self.thread().quit()
+        
+    def _on_ready_read(self):
+        infos = []
+        while self.socket.hasPendingDatagrams():
+            data, host, port= self.socket.readDatagram(self.socket.pendingDatagramSize())
+            host = QHostAddress(host.toIPv4Address())
+            if host==master_addr and data.startswith(b"Hock!"):
+                addresses = hqm.parse_server_list(data)
+                if addresses is not None:
+                    self.serverListReceived.emit(addresses)
+                continue
+            msg = hqm.parse_from_server(data)
+            if msg is None or msg["type"] != hqm.SCMD_INFO_RESPONSE:
+                continue
+            info = {key: msg[key] for key in info_keys}
+            info["ping"] = get_millis_truncated()-msg["ping"]
+            infos.append((host, port, info))
+        if infos:
+            self.infoReceived.emit(infos)
+
+class HQMSessionWorker(QObject):
+    # Owns the socket and session of a server window and decodes everything
+    # in its own thread. After each batch of datagrams the newest game state
+    # is posted to the window together with the new log entries, which are
+    # ("game", id) for a new game and ("event", msg) for events. Positions
+    # are calculated here before posting, and game states are not changed
+    # by anyone once they have been posted.
+    stateReady = pyqtSignal(object, object)
+    
+    def __init__(self, ip, port, username, reorder_window=0):
+        QObject.__init__(self)
+        self.ip = ip
+        self.port = port
+        self.session = hqm.HQMClientSession(username,55)
+        self.session.reorder_window = reorder_window
+        self.socket = None
+        self.update_timer = None
+        self.last_msg_pos = 0
+        self.gameID = 0
+        
+    @pyqtSlot()
+    def start(self):
+        self.socket = QUdpSocket(self)
+        self.socket.connectToHost(self.ip, self.port)
+        self.socket.readyRead.connect(self._on_ready_read)
+        self.update_timer = QTimer(self)
+        self.update_timer.setInterval(20)
+        self.update_timer.timeout.connect(self._on_timeout)
+        self.update_timer.start()
+        
+    @pyqtSlot(str)
+    def add_chat(self, text):
+        self.session.add_chat(text)
+        
+    @pyqtSlot()
+    def stop(self):
+        self.update_timer.stop()
+        self.socket.write(self.session.get_exit_message())
+        self.socket.close()
+        self.thread().quit()
+        
+    def _on_timeout(self):
+        send = self.session.get_message()
+        self.socket.write(send)
+        deadline = self.session.reorder_deadline()
+        if deadline is not None and time.monotonic() >= deadline:
+            # Nothing more arrived, stop waiting for the missing updates
+            gamestate = self.session.gamestate
+            self.session.flush_reorder_buffer()
+            if self.session.gamestate is not gamestate:
+                log = []
+                self.add_log(self.session.gamestate, log)
+                self.post_state(self.session.gamestate, log)
+        
+    def add_log(self, gamestate, log):
+        if self.gameID != self.session.last_game_id:  
+            self.gameID = self.session.last_game_id
+            self.last_msg_pos = 0
+            log.append(("game", self.gameID))
+        if gamestate.msg_pos>self.last_msg_pos:
+            events = gamestate.events[self.last_msg_pos:gamestate.msg_pos]
+            self.last_msg_pos = gamestate.msg_pos
+            log.extend(("event", msg) for msg in events)
+        
+    def _on_ready_read(self):
+        gamestate = None
+        log = []
+        while self.socket.hasPendingDatagrams():            
+            data = self.socket.read(8192)
+            new_gamestate = self.session.parse_message(data)
+            if not new_gamestate:
+                continue
+            gamestate = new_gamestate
+            self.add_log(gamestate, log)
+        if gamestate is not None:
+            self.post_state(gamestate, log)
+            
+    def post_state(self, gamestate, log):
+        gamestate.calculate_positions()
+        self.stateReady.emit(gamestate, log)
+
 class ServerListProxyTableModel(QSortFilterProxyModel):
     def lessThan(self, index1, index2):        
         if index1.column() == 0 and index2.column()==0:
@@ -40,18 +209,36 @@ class ServerListProxyTableModel(QSortFilterProxyModel):
     pass
 
 class ServerListTableModel(QAbstractTableModel):
+    probesReady = pyqtSignal(object)
+    serverListRequested = pyqtSignal()
+    stopRequested = pyqtSignal()
+    
     def __init__(self):
         QAbstractTableModel.__init__(self)
-        self.socket = QUdpSocket()
-        self.socket.bind(QHostAddress.Any)
-        self.socket.readyRead.connect(self._on_ready_read)
+        # Sending and decoding is done by the worker, this model only schedules
+        self.worker = ServerProbeWorker()
+        self.worker.serverListReceived.connect(self._on_server_list)
+        self.worker.infoReceived.connect(self._on_info)
+        self.probesReady.connect(self.worker.send_probes)
+        self.serverListRequested.connect(self.worker.request_server_list)
+        self.stopRequested.connect(self.worker.stop)
+        self.worker_thread = start_worker(self.worker)
         
         self.servers = []
         self.server_map = {}
+        self.server_rows = {} # Address to row in self.servers
+        self.changed_rows = set()
+        self.cache = servercache.HQMServerCache()
+        
+        self.visible = set()      # Addresses of servers shown in the view
+        self.visible_queue = []   # Heaps of (next probe time, counter, address)
+        self.probe_queue = []
+        self.probe_counter = itertools.count()
+        self.in_flight = {}       # Address to the time the probe was sent
         
         self.timer = QTimer()
         self.timer.timeout.connect(self._on_timeout)
-        self.timer.setInterval(1000)
+        self.timer.setInterval(int(probe_tick*1000))
         self.use_update = False
         self.use_public = False
         self.public_timer = QTimer()
@@ -59,76 +246,163 @@ class ServerListTableModel(QAbstractTableModel):
         self.public_timer.setInterval(2000)
 
         
-    def _on_ready_read(self):
-        while self.socket.hasPendingDatagrams():
+    def _on_server_list(self, addresses):
+        if self.use_public:
+            self.cache.put_server_list(master, addresses)
+            self.add_public_addresses(addresses)
             
-            data, host, port= self.socket.readDatagram(self.socket.pendingDatagramSize())
-            host = QHostAddress(host.toIPv4Address())
-            if host==master_addr and data.startswith(b"Hock!") and self.use_public:
-                addresses = hqm.parse_server_list(data)
-                new_servers = []
-                for ip, port in addresses:
-                    ip = QHostAddress(ip)
-                    addr = (ip, port)
-                    if addr not in self.server_map:
-                        new_server = {"ip":ip, "port":port}
-                        new_servers.append(new_server)
-                        self.server_map[addr] = new_server
-                if len(new_servers)>0:
-                    self.beginInsertRows(QModelIndex(), len(self.servers), len(self.servers)+len(new_servers)-1)
-                    self.servers.extend(new_servers)
-                    self.endInsertRows()
-            elif self.use_update:
-                host = QHostAddress(host.toIPv4Address())
-                msg = hqm.parse_from_server(data)
-                server = self.server_map.get((host, port))
-                if server is None:
-                    return
- 
-                #self.beginResetModel()
-                server["ping"] = get_millis_truncated()-msg["ping"]
-                server["players"] = msg["players"]
-                server["teamsize"] = msg["teamsize"]
-                server["version"] = msg["version"]
-                server["name"] = msg["name"]
-                index = self.servers.index(server)
-                self.dataChanged.emit(self.createIndex(index,0),self.createIndex(index,6))
-       
-
+    def _on_info(self, infos):
+        if not self.use_update:
+            return
+        for host, port, info in infos:
+            addr = (host, port)
+            server = self.server_map.get(addr)
+            if server is None:
+                continue
+                
+            self.in_flight.pop(addr, None)
+            if all(server.get(key) == info[key] for key in ("players", "teamsize", "version", "name")):
+                server["interval"] = min(server["interval"]*1.5, unchanged_probe_interval)
+            else:
+                server["interval"] = probe_interval
+            self.schedule_probe(addr)
+            server.update(info)
+            self.cache.put_info(host.toString(), port, info)
+            self.row_changed(self.server_rows[addr])
+                
+    def row_changed(self, row):
+        # Changes are collected and announced together once control
+        # returns to the event loop
+        if not self.changed_rows:
+            QTimer.singleShot(0, self.emit_changed_rows)
+        self.changed_rows.add(row)
+        
+    def emit_changed_rows(self):
+        if not self.changed_rows:
+            return
+        first = min(self.changed_rows)
+        last = max(self.changed_rows)
+        self.changed_rows.clear()
+        self.dataChanged.emit(self.createIndex(first,0),self.createIndex(last,6))
+        
+    def add_public_addresses(self, addresses):
+        new_servers = []
+        for ip, port in addresses:
+            ip = QHostAddress(ip)
+            addr = (ip, port)
+            if addr not in self.server_map:
+                new_server = {"ip":ip, "port":port, "interval":probe_interval}
+                self.apply_cached_info(new_server)
+                self.server_rows[addr] = len(self.servers) + len(new_servers)
+                new_servers.append(new_server)
+                self.server_map[addr] = new_server
+                self.schedule_probe(addr, random.uniform(0, probe_interval))
+        if len(new_servers)>0:
+            self.beginInsertRows(QModelIndex(), len(self.servers), len(self.servers)+len(new_servers)-1)
+            self.servers.extend(new_servers)
+            self.endInsertRows()
+            
+    def schedule_probe(self, addr, delay=None):
+        server = self.server_map[addr]
+        visible = addr in self.visible
+        if delay is None:
+            delay = probe_interval if visible else server["interval"]
+        server["next_probe"] = time.monotonic() + delay
+        queue = self.visible_queue if visible else self.probe_queue
+        heapq.heappush(queue, (server["next_probe"], next(self.probe_counter), addr))
+        
+    def set_visible_rows(self, rows):
+        # Servers in these rows are probed before all others, at the normal rate
+        self.visible = {(self.servers[row]["ip"], self.servers[row]["port"]) for row in rows}
+        now = time.monotonic()
+        self.visible_queue = []
+        self.probe_queue = []
+        for addr, server in self.server_map.items():
+            if addr in self.visible:
+                server["next_probe"] = min(server["next_probe"], now + probe_interval)
+                queue = self.visible_queue
+            else:
+                queue = self.probe_queue
+            queue.append((server["next_probe"], next(self.probe_counter), addr))
+        heapq.heapify(self.visible_queue)
+        heapq.heapify(self.probe_queue)
+            
+    def apply_cached_info(self, server):
+        info, fresh = self.cache.get_info(server["ip"].toString(), server["port"])
+        if info is not None:
+            server.update(info)
         
     def _on_timeout(self):
-        for server in self.servers:
-            address = server["ip"]
-            port = server["port"]
-            millis = get_millis_truncated()
-            message = hqm.make_info_request_cmessage(55, millis)
-            self.socket.writeDatagram(message, address, port)
- 
+        now = time.monotonic()
+        for addr, sent in list(self.in_flight.items()):
+            if now - sent < probe_timeout:
+                continue
+            del self.in_flight[addr]
+            server = self.server_map.get(addr)
+            if server is not None:
+                server["interval"] = min(server["interval"]*2, unresponsive_probe_interval)
+                self.schedule_probe(addr)
+                
+        # Enough probes per tick to get through all servers once per probe_interval
+        budget = math.ceil(len(self.servers) * probe_tick / probe_interval)
+        probes = []
+        for queue in (self.visible_queue, self.probe_queue):
+            while queue and queue[0][0] <= now and budget > 0 and len(self.in_flight) < max_probes_in_flight:
+                next_probe, counter, addr = heapq.heappop(queue)
+                server = self.server_map.get(addr)
+                if server is None or server["next_probe"] != next_probe or addr in self.in_flight:
+                    continue # Removed or rescheduled
+                probes.append(addr)
+                self.in_flight[addr] = now
+                budget -= 1
+        if probes:
+            self.probesReady.emit(probes)
+        self.cache.maybe_save()
             
     def _on_public_timeout(self):
-        self.socket.writeDatagram(hqm.server_list_message, master_addr, master_port)
+        addresses, fresh = self.cache.get_server_list(master)
+        if addresses is not None:
+            self.add_public_addresses(addresses)
+        if not fresh:
+            self.serverListRequested.emit()
+        self.cache.maybe_save()
       
     def add_server(self, ip, port):
         addr = (ip, port)
         if addr not in self.server_map:
         
-            new_server = {"ip":ip, "port":port}
+            new_server = {"ip":ip, "port":port, "interval":probe_interval}
+            self.apply_cached_info(new_server)
             self.beginInsertRows(QModelIndex(), len(self.servers), len(self.servers))   
+            self.server_rows[addr] = len(self.servers)
             self.servers.append(new_server)
             self.server_map[addr] = new_server
+            self.schedule_probe(addr, 0)
             self.endInsertRows()
             
     def remove_server(self, index):   
+        self.emit_changed_rows() # Pending rows are about to move
         server = self.servers[index]
         self.beginRemoveRows(QModelIndex(), index, index) 
         del self.server_map[(server["ip"], server["port"])]
+        del self.server_rows[(server["ip"], server["port"])]
+        self.in_flight.pop((server["ip"], server["port"]), None)
         del self.servers[index]
+        for row in range(index, len(self.servers)):
+            moved = self.servers[row]
+            self.server_rows[(moved["ip"], moved["port"])] = row
         self.endRemoveRows()
 
     def clear(self):
         self.beginResetModel()
         self.servers = []
         self.server_map = {}
+        self.server_rows = {}
+        self.changed_rows.clear()
+        self.visible = set()
+        self.visible_queue = []
+        self.probe_queue = []
+        self.in_flight = {}
         self.endResetModel()
             
     def add_public(self, state):
@@ -146,6 +420,18 @@ class ServerListTableModel(QAbstractTableModel):
             self.timer.start()
         else:
             self.timer.stop()       
+            # Their replies will be ignored, so they are probed again first
+            # when updates resume
+            for addr in self.in_flight:
+                if addr in self.server_map:
+                    self.schedule_probe(addr, 0)
+            self.in_flight.clear()
+            
+    def close(self):
+        self.timer.stop()
+        self.public_timer.stop()
+        self.stopRequested.emit()
+        self.worker_thread.wait()
     
 
     def headerData(self, col, orientation, role):
@@ -222,15 +508,55 @@ class ServerUserListTableModel(QAbstractTableModel):
         return 5
         
     def set_state(self, state):
+        # Rows are kept sorted by player index. Only the rows that were
+        # removed, inserted or changed are signalled to the views.
+        old_you = self.you
         self.you = state.you
         new_players = sorted(state.players.values(), key=lambda s: s["index"])
-        if(len(new_players)!=len(self.players)):
-            self.beginResetModel()
-            self.players = new_players
-            self.endResetModel()
-        else:
-            self.players = new_players
-            self.dataChanged.emit(self.createIndex(0,0),self.createIndex(len(self.players),4))
+        new_indices = set(player["index"] for player in new_players)
+        
+        # Removed players, in runs from the bottom so that rows don't move
+        row = len(self.players)-1
+        while row >= 0:
+            if self.players[row]["index"] in new_indices:
+                row -= 1
+                continue
+            last = row
+            while row >= 0 and self.players[row]["index"] not in new_indices:
+                row -= 1
+            self.beginRemoveRows(QModelIndex(), row+1, last)
+            del self.players[row+1:last+1]
+            self.endRemoveRows()
+            
+        # New players, in runs
+        old_indices = set(player["index"] for player in self.players)
+        row = 0
+        while row < len(new_players):
+            if new_players[row]["index"] in old_indices:
+                row += 1
+                continue
+            first = row
+            while row < len(new_players) and new_players[row]["index"] not in old_indices:
+                row += 1
+            self.beginInsertRows(QModelIndex(), first, row-1)
+            self.players[first:first] = new_players[first:row]
+            self.endInsertRows()
+            
+        # Changed players, in runs. Unchanged players are the same dict.
+        changed = []
+        for row, (old_player, new_player) in enumerate(zip(self.players, new_players)):
+            index = new_player["index"]
+            if old_you != self.you and (index == old_you or index == self.you):
+                changed.append(row)
+            elif old_player is not new_player and any(old_player[key] != new_player[key]
+                                                      for key in ("name", "team", "goal", "assist")):
+                changed.append(row)
+        self.players = new_players
+        while changed:
+            first = last = changed.pop(0)
+            while changed and changed[0] == last+1:
+                last = changed.pop(0)
+            self.dataChanged.emit(self.createIndex(first, 0), self.createIndex(last, 4))
             
     def data(self, index, role):
 
@@ -285,14 +611,21 @@ class ServerUserListTableModel(QAbstractTableModel):
         return QVariant()
        
 triangle = QPolygonF([QPointF(0, -0.4), QPointF(-0.7, 0), QPointF(-0.7, 0.4), QPointF(0.7, 0.4),QPointF(0.7, 0)])
-red_net = [QPointF(13.5, 57), QPointF(13.5, 58), QPointF(16.5, 58), QPointF(16.5, 57)]
-blue_net = [QPointF(13.5, 4), QPointF(13.5, 3), QPointF(16.5, 3), QPointF(16.5, 4)]
+red_net = [QPointF(x, z) for x, z in hqm.red_net]
+blue_net = [QPointF(x, z) for x, z in hqm.blue_net]
 
        
 class HQMMiniMap(QWidget):
     def __init__(self):
         QWidget.__init__(self)
         self.gamestate = None
+        # The rink never changes, so it is drawn once per widget size
+        self.rink_pixmap = None
+        self.team_colors = {0: QColor(255,0,0), 1: QColor(0,0,255)}
+        self.team_pens = {team: QPen(color) for team, color in self.team_colors.items()}
+        self.puck_color = QColor(0,0,0)
+        self.index_font = QFont()
+        self.index_font.setPointSizeF(1.5)
         
     def set_state(self, gamestate):
         self.gamestate = gamestate
@@ -305,123 +638,129 @@ class HQMMiniMap(QWidget):
         #    print(type + ": " + str(pos))
  
     def get_player(self, i):
-        for player_i, player in self.gamestate.players.items():
-            if player["obj"]==i:
-                return player
-        return None 
+        return self.gamestate.object_player(i)
         
-    def paintEvent(self, event):     
+    def rink_transform(self):
         scale = min(self.width()/32, self.height()/64)
+        transform = QTransform()
+        transform.translate(4,4)
+        transform.scale(scale, scale)
+        return transform
+        
+    def resizeEvent(self, event):
+        self.rink_pixmap = None
+        QWidget.resizeEvent(self, event)
+        
+    def get_rink_pixmap(self):
+        if self.rink_pixmap is not None:
+            return self.rink_pixmap
+        ratio = self.devicePixelRatioF()
+        pixmap = QPixmap(self.size() * ratio)
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
         
         painter = QPainter()
-        painter.begin(self)
+        painter.begin(pixmap)
         painter.setRenderHint(QPainter.Antialiasing)
-        painter.translate(4,4)
-        painter.scale(scale, scale)
-  
-        painter.save() 
+        painter.setTransform(self.rink_transform())
         painter.setBrush(QColor(255,255,255))   
         painter.setPen(Qt.NoPen)        
-        painter.drawRoundedRect(0,0,30,61, 8.5, 8.5) 
-        painter.restore()
+        painter.drawRoundedRect(0,0,hqm.rink_width,hqm.rink_length, hqm.rink_corner_radius, hqm.rink_corner_radius) 
         
-        painter.save()
         netpen = QPen()
-        netpen.setColor(QColor(255,0,0))
-        netpen.setWidth(0.5)
-        painter.setPen(netpen)            
-        for a, b in pairwise(red_net):
-            painter.drawLine(a, b)     
-        netpen.setColor(QColor(0,0,255))
-        netpen.setWidth(0.5)
-        painter.setPen(netpen)
-        for a, b in pairwise(blue_net):
-            painter.drawLine(a, b)
-        painter.restore()
+        netpen.setWidthF(0.5)
+        for net, team in ((red_net, 0), (blue_net, 1)):
+            netpen.setColor(self.team_colors[team])
+            painter.setPen(netpen)            
+            for a, b in pairwise(net):
+                painter.drawLine(a, b)     
+        painter.end()
+        self.rink_pixmap = pixmap
+        return pixmap
+        
+    def paintEvent(self, event):     
+        painter = QPainter()
+        painter.begin(self)
+        painter.drawPixmap(0, 0, self.get_rink_pixmap())
         
         if not self.gamestate:
             painter.end()
             return
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setFont(self.index_font)
+        base = self.rink_transform()
         objects = self.gamestate.objects
         for i, object in objects.items():
-            object.calculate_positions()
+            if not object.calculated:
+                continue # Calculated by HQMSessionWorker before posting
             pos = object["pos"]
             type = object["type"]
             if type=="PUCK":             
                 puck = QRectF(-0.3, -0.3, 0.6, 0.6)
-                painter.save()
+                painter.setTransform(base)
                 painter.translate(pos[0], pos[2])
                 painter.setPen(Qt.NoPen)
-                painter.setBrush(QColor(0,0,0))  
+                painter.setBrush(self.puck_color)  
                 painter.drawEllipse(puck)
-                painter.restore()
             elif type=="PLAYER":
                 
                 player = self.get_player(i)
-                if player is None or player["team"]==-1:
+                if player is None or player["team"] not in self.team_colors:
                     continue
                 index = str(player["index"])
                 team = player["team"]
+                c = self.team_colors[team]
                 
-                if team == 0:     
-                    c = QColor(255,0,0)       
-                elif team == 1:
-                    c = QColor(0,0,255)
-                
-                painter.save()
+                painter.setTransform(base)
                 painter.translate(pos[0], pos[2])
-                fontpen = QPen()
-                fontpen.setColor(c)
-                painter.setPen(fontpen)
-                font = QFont()
-                font.setPointSizeF (1.5)
-                painter.setFont(font)
+                painter.setPen(self.team_pens[team])
                 painter.drawText (QRectF (1, -1.0, 3, 2), Qt.AlignVCenter | Qt.AlignLeft, index)
-                painter.restore ()
                 
-                painter.save()
-                painter.translate(pos[0], pos[2])
                 rot = object["rot"]
                 transform = QTransform(rot[2][2], rot[2][0], rot[0][2], rot[0][0], 0, 0)
                 painter.setTransform(transform, True)
                 painter.setPen(Qt.NoPen)
                 painter.setBrush (c)
                 painter.drawConvexPolygon(triangle)
-                painter.restore()
                 
-                painter.save()
                 stick_pos = object["stick_pos"]
                 stick_rot = object["stick_rot"]
+                painter.setTransform(base)
                 painter.translate(stick_pos[0], stick_pos[2])
                 transform = QTransform(stick_rot[2][2], stick_rot[2][0], stick_rot[0][2], stick_rot[0][0], 0, 0)
                 painter.setTransform(transform, True)
-                painter.setPen(Qt.NoPen)
-                painter.setBrush (c)
                 painter.drawRect(QRectF (-0.125, -0.25, 0.25, 0.5))
-                painter.restore()
         painter.end()
         
 class HQMServerGUI(QWidget):
     closedServerDialog = pyqtSignal(QHostAddress, int)
+    chatRequested = pyqtSignal(str)
+    stopRequested = pyqtSignal()
 
-    def __init__(self, ip, port, username):
+    def __init__(self, ip, port, username, fps=default_fps, max_log_lines=default_max_log_lines,
+                 reorder_window=default_reorder_window):
         QWidget.__init__(self)
         self.ip = ip
         self.port = port
         self.setWindowTitle("{}:{}".format(self.ip.toString(), self.port))
         
-        self.socket = QUdpSocket()
-        self.socket.connectToHost(self.ip, self.port)
-        self.socket.readyRead.connect(self._on_ready_read)
-        self.last_msg_pos = 0
-        self.gameID = 0
-        self.session = hqm.HQMClientSession(username,55)
         self.player_list = {}
+        self.gamestate = None
+        # Views are refreshed by display_timer, and only if something arrived
+        self.dirty = False
+        self.label_texts = {}
+        self.shown_players = None
+        self.shown_you = None
+        self.shown_simstep = None
+        # Log entries waiting to be shown, ("game", id) or ("event", msg)
+        self.pending_log = []
+        self.max_log_lines = max_log_lines
         
         main_layout = QGridLayout()
         
         self.event_list = QTextEdit()
         self.event_list.setReadOnly(True)
+        self.event_list.document().setMaximumBlockCount(max_log_lines)
         
         
         self.info_table = QFormLayout()
@@ -455,7 +794,7 @@ class HQMServerGUI(QWidget):
         def chat():
             text = self.chat_field.text()
             self.chat_field.clear()
-            self.session.add_chat(text)
+            self.chatRequested.emit(text)
         
         self.chat_button.clicked.connect(chat)
         self.chat_field.returnPressed.connect(chat)
@@ -488,36 +827,45 @@ class HQMServerGUI(QWidget):
         self.resize(900, 600)
         self.setLayout(main_layout)
         
-        self.update_timer = QTimer()
-        self.update_timer.setInterval(20)
-        self.update_timer.timeout.connect(self._on_timeout)
-        self.update_timer.start()
+        self.worker = HQMSessionWorker(self.ip, self.port, username, reorder_window)
+        self.worker.stateReady.connect(self._on_state)
+        self.chatRequested.connect(self.worker.add_chat)
+        self.stopRequested.connect(self.worker.stop)
+        self.worker_thread = start_worker(self.worker)
         
-    def _on_timeout(self):
-        send = self.session.get_message()
-        self.socket.write(send)
+        self.display_timer = QTimer()
+        self.set_fps(fps)
+        self.display_timer.timeout.connect(self._on_display_timeout)
+        self.display_timer.start()
         
-    def _on_ready_read(self):
-        while self.socket.hasPendingDatagrams():            
-            data = self.socket.read(8192)
-            self.gamestate = self.session.parse_message(data)
-            if not self.gamestate:
-                return
-            if self.gameID != self.session.last_game_id:  
-                self.reset_log(self.session.last_game_id)
-            if(self.gamestate.msg_pos>self.last_msg_pos):
-                events = self.gamestate.events[self.last_msg_pos:self.gamestate.msg_pos]
-                self.last_msg_pos = self.gamestate.msg_pos
-                for msg in events:
-                    hqm.update_player_list(self.player_list, msg)
-                    self.insert_event(msg)
+    def _on_state(self, gamestate, log):
+        self.gamestate = gamestate
+        self.dirty = True
+        self.pending_log.extend(log)
                  
-        # To be continued.....
+    def set_fps(self, fps):
+        # The views are redrawn at most fps times per second
+        self.display_timer.setInterval(max(1, int(1000/fps)))
+        
+    def _on_display_timeout(self):
+        self.render_log()
+        if not self.dirty or not self.gamestate:
+            return
+        self.dirty = False
+        gamestate = self.gamestate
         self.update_info_label()
-        self.user_table_model.set_state(self.gamestate)
-        self.minimap.set_state(self.gamestate)
- 
+        if gamestate.players != self.shown_players or gamestate.you != self.shown_you:
+            self.shown_players = gamestate.players
+            self.shown_you = gamestate.you
+            self.user_table_model.set_state(gamestate)
+        if gamestate.simstep != self.shown_simstep:
+            self.shown_simstep = gamestate.simstep
+            self.minimap.set_state(gamestate)
                     
+    def set_label_text(self, label, text):
+        if self.label_texts.get(label) != text:
+            self.label_texts[label] = text
+            label.setText(text)
                     
     def update_info_label(self):
         period = self.gamestate.period
@@ -525,110 +873,87 @@ class HQMServerGUI(QWidget):
             period = "Warmup"
         else:
             period = str(period)
-        self.period_label.setText(period)
+        self.set_label_text(self.period_label, period)
         time_left = self.gamestate.time
         minutes = time_left//6000
         seconds = (time_left - (minutes*6000)) // 100
-        self.time_label.setText("{}:{:0>2}".format(minutes, seconds))
+        self.set_label_text(self.time_label, "{}:{:0>2}".format(minutes, seconds))
         time_left = self.gamestate.timeout
         minutes = time_left//6000
         seconds = (time_left - (minutes*6000)) // 100
-        self.timeout_label.setText("{}:{:0>2}".format(minutes, seconds))
-        self.score_label.setText("<font color='red'>{}</font> - <font color='blue'>{}</font>".format(self.gamestate.redscore, self.gamestate.bluescore))
+        self.set_label_text(self.timeout_label, "{}:{:0>2}".format(minutes, seconds))
+        self.set_label_text(self.score_label, "<font color='red'>{}</font> - <font color='blue'>{}</font>".format(self.gamestate.redscore, self.gamestate.bluescore))
         
 
 
                          
-    def insert_event(self, msg):   
+    def render_log(self):
+        # Everything that arrived since the last frame is inserted in one
+        # edit block. Entries that would be removed by the line limit right
+        # away are only used to keep the player list up to date.
+        if not self.pending_log:
+            return
+        pending = self.pending_log
+        self.pending_log = []
+        skip = len(pending) - self.max_log_lines
         cursor = self.event_list.textCursor()
         cursor.movePosition(QTextCursor.End)
-              
-        def get_team_format(team):
-            team_format = QTextCharFormat()
-            team_format.setFontWeight(QFont.Bold)
-            if team==-1:
-                team_format.setForeground(QBrush(QColor("grey")))
-            elif team==0:
-                team_format.setForeground(QBrush(QColor("red")))
-            elif team==1:
-                team_format.setForeground(QBrush(QColor("blue")))
-            return team_format
-            
-        def insert_player(cursor, name, i):
-            cursor.setCharFormat(player_format)
-            cursor.insertText(name)
-            cursor.setCharFormat(old_format)
-            cursor.insertText(" (#{})".format(i))  
+        cursor.beginEditBlock()
+        for n, (kind, value) in enumerate(pending):
+            if kind == "game":
+                self.player_list = {}
+                if n >= skip:
+                    cursor.insertText("New game starting ({})\n".format(value), server_format)
+            else:
+                hqm.update_player_list(self.player_list, value)
+                if n >= skip:
+                    self.insert_event(cursor, value)
+        cursor.endEditBlock()
+                         
+    def insert_event(self, cursor, msg):
+        def insert_player(name, i):
+            cursor.insertText(name, player_format)
+            cursor.insertText(" (#{})".format(i), old_format)
             
-        def insert_team(cursor, team):
-            team_format = get_team_format(team)
-            cursor.setCharFormat(team_format)
-            if team==-1:                   
-                cursor.insertText("the spectators")  
-            elif team==0:
-                cursor.insertText("the red team")  
-            elif team==1:
-                cursor.insertText("the blue team")
-            cursor.setCharFormat(old_format)                    
+        def insert_team(team):
+            if team in team_formats:
+                cursor.insertText(team_names[team], team_formats[team])
             
         if msg["type"]=="JOIN" or msg["type"]=="EXIT":
-            name = msg["name"]
-            i = msg["player"]
-            team = msg["team"]
-            insert_player(cursor, name, i)
+            insert_player(msg["name"], msg["player"])
             if msg["type"]=="JOIN":
-                cursor.insertText(" has joined ")             
-                insert_team(cursor, team)
+                cursor.insertText(" has joined ", old_format)
+                insert_team(msg["team"])
+                cursor.insertText(".\n", old_format)
             else:
-                cursor.insertText(" has exited")
-            cursor.insertText(".\n") 
+                cursor.insertText(" has exited.\n", old_format)
         elif msg["type"]=="CHAT":
             i = msg["player"]
-            message = msg["message"]
             if i==-1:
-                cursor.setCharFormat(server_format)
-                cursor.insertText("Server")
-                cursor.setCharFormat(old_format)
+                cursor.insertText("Server", server_format)
             else:    
-                player = self.player_list[i]
-                name = player["name"]
-                insert_player(cursor, name, i)
-            cursor.insertText(": {}\n".format(message))
+                insert_player(self.player_list[i]["name"], i)
+            cursor.insertText(": {}\n".format(msg["message"]), old_format)
         elif msg["type"]=="GOAL":
-            team = msg["team"]
             scoring = self.player_list.get(msg["scoring_player"])
             assisting = self.player_list.get(msg["assisting_player"])
-            cursor.setCharFormat(goal_format)
-            cursor.insertText("GOAL! ")
-            cursor.setCharFormat(old_format)
+            cursor.insertText("GOAL! ", goal_format)
             if scoring:
-                insert_player(cursor, scoring["name"], scoring["index"])
+                insert_player(scoring["name"], scoring["index"])
                 if assisting:
-                    cursor.insertText(" (assisted by ")
-                    insert_player(cursor, assisting["name"], assisting["index"])
-                    cursor.insertText(")")
+                    cursor.insertText(" (assisted by ", old_format)
+                    insert_player(assisting["name"], assisting["index"])
+                    cursor.insertText(")", old_format)
             else:
-                cursor.insertText("The puck")
-            cursor.insertText(" scored for ")
-            insert_team(cursor, team)
-            cursor.insertText(".\n") 
-        
-            
+                cursor.insertText("The puck", old_format)
+            cursor.insertText(" scored for ", old_format)
+            insert_team(msg["team"])
+            cursor.insertText(".\n", old_format)
            
-    def reset_log(self, gameID):
-        cursor = self.event_list.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        cursor.setCharFormat(server_format)
-        cursor.insertText("New game starting ({})\n".format(gameID))
-        cursor.setCharFormat(old_format)
-        self.last_msg_pos = 0
-        self.player_list = {}
-        self.gameID = gameID 
-        
     def closeEvent(self, event):
-        self.update_timer.stop()
-        self.socket.write(self.session.get_exit_message())
-        self.socket.close() 
+        self.display_timer.stop()
+        self.stopRequested.emit()
+        self.worker_thread.wait()
         self.closedServerDialog.emit(self.ip, self.port)
         QWidget.closeEvent(self, event)
 
@@ -678,12 +1003,26 @@ class HQMUtilsGUI(QWidget):
         self.table.setColumnWidth(4, 60)
         self.table.setColumnWidth(5, 60)
         self.table.setColumnWidth(6, 200)
+        
+        # The model probes the servers that can be seen first
+        self.visible_timer = QTimer()
+        self.visible_timer.setSingleShot(True)
+        self.visible_timer.setInterval(100)
+        self.visible_timer.timeout.connect(self.update_visible_rows)
+        self.table.verticalScrollBar().valueChanged.connect(self.visible_timer.start)
+        self.proxy_model.layoutChanged.connect(self.visible_timer.start)
+        self.proxy_model.rowsInserted.connect(self.visible_timer.start)
+        self.proxy_model.rowsRemoved.connect(self.visible_timer.start)
 
         self.load_public_box = QCheckBox("Load public servers")
         self.load_public_box.stateChanged.connect(self.load_public_servers)
         self.update_box = QCheckBox("Update servers")
         self.update_box.stateChanged.connect(self.update_servers)
         self.update_box.setCheckState(2)
+        self.fps_box = QSpinBox()
+        self.fps_box.setRange(1, 240)
+        self.fps_box.setValue(default_fps)
+        self.fps_box.valueChanged.connect(self.set_fps)
         self.join_button = QPushButton("Join")
         self.join_button.clicked.connect(self.show_server)
         self.clear_button = QPushButton("Remove all")
@@ -704,6 +1043,8 @@ class HQMUtilsGUI(QWidget):
         lower_box.addWidget(self.user_name_field, 0, 1)
         lower_box.addWidget(self.load_public_box, 1, 0, 1, 2)
         lower_box.addWidget(self.update_box, 2, 0, 1, 2)
+        lower_box.addWidget(QLabel("Max FPS"), 3, 0)
+        lower_box.addWidget(self.fps_box, 3, 1)
        
         lower_box.setColumnStretch(2,1)
         lower_box.addWidget(self.remove_button, 0, 3)
@@ -716,6 +1057,29 @@ class HQMUtilsGUI(QWidget):
 
         self.setLayout(main_layout) 
         
+    def resizeEvent(self, event):
+        QWidget.resizeEvent(self, event)
+        self.visible_timer.start()
+        
+    def update_visible_rows(self):
+        rows = self.proxy_model.rowCount()
+        if rows == 0:
+            self.model.set_visible_rows([])
+            return
+        first = self.table.rowAt(0)
+        last = self.table.rowAt(self.table.viewport().height()-1)
+        if first == -1:
+            first = 0
+        if last == -1:
+            last = rows-1
+        source_rows = [self.proxy_model.mapToSource(self.proxy_model.index(row, 0)).row()
+                       for row in range(first, last+1)]
+        self.model.set_visible_rows(source_rows)
+        
+    def set_fps(self, fps):
+        for server_gui in self.server_gui.values():
+            server_gui.set_fps(fps)
+        
     def is_valid_username(self, username):
         b = username.encode("ascii", "ignore")
         return len(b)>0
@@ -734,7 +1098,7 @@ class HQMUtilsGUI(QWidget):
         def on_close(ip, port):
             del self.server_gui[(ip, port)]
         if (ip, port) not in self.server_gui:
-            self.server_gui[(ip, port)] = HQMServerGUI(ip, port, username)
+            self.server_gui[(ip, port)] = HQMServerGUI(ip, port, username, self.fps_box.value())
             self.server_gui[(ip, port)].closedServerDialog.connect(on_close)      
         self.server_gui[(ip, port)].show()
         self.server_gui[(ip, port)].setWindowState(Qt.WindowActive)
@@ -779,6 +1143,8 @@ def show_gui():
     w = HQMUtilsGUI()
     w.resize(700, 500);  
     w.show()
+    app.aboutToQuit.connect(w.model.close)
+    app.aboutToQuit.connect(w.model.cache.save)
     sys.exit(app.exec_())    
 
 